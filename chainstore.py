@@ -0,0 +1,462 @@
+import os
+import mmap
+import struct
+import tempfile
+import unittest
+import zlib
+from typing import Optional
+
+from test_framework.script import OP_CHECKTEMPLATEVERIFY
+from utils import SpacechainTx
+
+MAGIC = b"SPCCHAIN"
+VERSION = 1
+
+# magic, version, chain max, record size
+HEADER = struct.Struct("<8sHII")
+HEADER_SIZE = 64
+
+# last known tip of the chain + 1 (0 when unknown), in the header padding
+TIP = struct.Struct("<Q")
+TIP_OFFSET = 32
+
+# number of records made durable by the last sync, also in the header padding
+DURABLE = struct.Struct("<Q")
+DURABLE_OFFSET = 40
+
+# template length, template bytes, ctv hash, crc of those three,
+# mined txid, crc of the txid -- padded to a round record size
+TMPL_MAX = 160
+RECORD = struct.Struct(f"<H{TMPL_MAX}s32sI32sI22x")
+RECORD_SIZE = RECORD.size
+BODY_SIZE = 2 + TMPL_MAX + 32
+TXID_OFFSET = BODY_SIZE + 4
+TXID = struct.Struct("<32sI")
+
+EMPTY_TXID = bytes(32)
+
+# magic, chain max, CTV hash of the genesis, number of slots
+INDEX_MAGIC = b"SPCINDEX"
+INDEX_HEADER = struct.Struct("<8sI32sQ")
+
+# first 8 bytes of a CTV hash, position + 1 (0 marks an empty slot)
+SLOT = struct.Struct("<QI")
+
+
+class _Positions:
+    """Position bookkeeping shared by the store and its read-only view."""
+
+    chain_max: int
+    count: int
+
+    def _index(self, i: int) -> int:
+        if not self.lowest <= i <= self.chain_max:
+            raise KeyError(i)
+        return self.chain_max - i
+
+    @property
+    def lowest(self) -> int:
+        """The lowest position built so far (chain_max + 1 if none)."""
+        return self.chain_max + 1 - self.count
+
+    def __len__(self):
+        return self.chain_max + 1 - self.lowest
+
+    def __contains__(self, i: int) -> bool:
+        return self.lowest <= i <= self.chain_max
+
+    def _recover(self, durable: int, available: int) -> int:
+        """
+        The number of intact records: the durable ones, then the following
+        ones up to the first that fails its checksum.
+        """
+        count = min(durable, available)
+        while count < available and self._valid(count):
+            count += 1
+        return count
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class ChainStore(_Positions):
+    """
+    Append-only store of the precomputed covenant string.
+
+    Positions are generated back-to-front, so the record for position `i` is
+    the `chain_max - i`-th one appended. Each record has a fixed size and
+    holds the template bytes, the CTV hash and the txid under which the
+    position was mined, which makes lookups and txid updates O(1).
+
+    Every record carries a checksum of its body and another one of its txid,
+    and the header holds the number of records made durable by the last
+    sync(). Records written after it may have reached the disk partly and
+    in any order, so when the store is reopened they are checked and the
+    file is cut at the first torn one (the rest is regenerated by the next
+    run). A half-written txid reads as unknown (and is rediscovered from the
+    chain).
+    """
+
+    def __init__(self, path: str, chain_max: int):
+        self.path = path
+        self.chain_max = chain_max
+        self._pending = bytearray()
+
+        if not self._open_existing():
+            self._create()
+
+    def _open_existing(self) -> bool:
+        try:
+            self.f = open(self.path, "r+b")
+        except FileNotFoundError:
+            return False
+
+        magic, version, chain_max, record_size = HEADER.unpack(
+            self.f.read(HEADER_SIZE)[: HEADER.size].ljust(HEADER.size, b"\0")
+        )
+        if (magic, version, chain_max, record_size) != (
+            MAGIC,
+            VERSION,
+            self.chain_max,
+            RECORD_SIZE,
+        ):
+            # a different chain (or a different format), start over
+            self.f.close()
+            return False
+
+        size = os.fstat(self.f.fileno()).st_size
+        (self._durable,) = DURABLE.unpack(
+            os.pread(self.f.fileno(), DURABLE.size, DURABLE_OFFSET)
+        )
+        self.count = self._recover(self._durable, (size - HEADER_SIZE) // RECORD_SIZE)
+
+        # drop what follows a record only partially written before a crash
+        if size != HEADER_SIZE + self.count * RECORD_SIZE:
+            self.f.truncate(HEADER_SIZE + self.count * RECORD_SIZE)
+
+        return True
+
+    def _create(self):
+        self.f = open(self.path, "w+b")
+        self.f.write(
+            HEADER.pack(MAGIC, VERSION, self.chain_max, RECORD_SIZE).ljust(
+                HEADER_SIZE, b"\0"
+            )
+        )
+        self.count = 0
+        self._durable = 0
+        self.sync()
+
+    def _valid(self, index: int) -> bool:
+        raw = os.pread(self.f.fileno(), BODY_SIZE + 4, self._offset(index))
+        if len(raw) < BODY_SIZE + 4:
+            return False
+        (crc,) = struct.unpack_from("<I", raw, BODY_SIZE)
+        return zlib.crc32(raw[:BODY_SIZE]) == crc
+
+    def _offset(self, index: int) -> int:
+        return HEADER_SIZE + index * RECORD_SIZE
+
+    @property
+    def lowest(self) -> int:
+        return super().lowest - len(self._pending) // RECORD_SIZE
+
+    def append(self, tmpl_bytes: bytes, ctv_hash: bytes) -> int:
+        """Add the position right before the lowest one built and return it."""
+        if len(tmpl_bytes) > TMPL_MAX:
+            raise ValueError(
+                f"template has {len(tmpl_bytes)} bytes, the store holds up to {TMPL_MAX}"
+            )
+        if self.lowest == 0:
+            raise ValueError("the chain is already complete")
+
+        body = struct.pack(f"<H{TMPL_MAX}s32s", len(tmpl_bytes), tmpl_bytes, ctv_hash)
+        self._pending += RECORD.pack(
+            len(tmpl_bytes),
+            tmpl_bytes,
+            ctv_hash,
+            zlib.crc32(body),
+            EMPTY_TXID,
+            0,
+        )
+        return self.lowest
+
+    def _flush(self):
+        if self._pending:
+            os.pwrite(self.f.fileno(), self._pending, self._offset(self.count))
+            self.count += len(self._pending) // RECORD_SIZE
+            self._pending = bytearray()
+
+    def sync(self):
+        """Write pending records and make everything durable."""
+        self._flush()
+        self.f.flush()
+        os.fsync(self.f.fileno())
+        # only once the records themselves are on disk
+        if self._durable != self.count:
+            os.pwrite(self.f.fileno(), DURABLE.pack(self.count), DURABLE_OFFSET)
+            os.fsync(self.f.fileno())
+            self._durable = self.count
+
+    def __getitem__(self, i: int) -> SpacechainTx:
+        index = self._index(i)
+        self._flush()
+        (
+            tmpl_len,
+            tmpl_bytes,
+            ctv_hash,
+            _,
+            txid,
+            txid_crc,
+        ) = RECORD.unpack(os.pread(self.f.fileno(), RECORD_SIZE, self._offset(index)))
+
+        tx = SpacechainTx(
+            tmpl_bytes=tmpl_bytes[:tmpl_len], id=_decode_txid(txid, txid_crc)
+        )
+        tx._ctv_hashes[0] = ctv_hash
+        return tx
+
+    def get_id(self, i: int) -> Optional[str]:
+        index = self._index(i)
+        self._flush()
+        raw = os.pread(self.f.fileno(), TXID.size, self._offset(index) + TXID_OFFSET)
+        return _decode_txid(*TXID.unpack(raw))
+
+    @property
+    def tip(self) -> Optional[int]:
+        """The last position known to be published, if any."""
+        (tip,) = TIP.unpack(os.pread(self.f.fileno(), TIP.size, TIP_OFFSET))
+        return tip - 1 if tip else None
+
+    def set_tip(self, i: Optional[int]):
+        os.pwrite(self.f.fileno(), TIP.pack(0 if i is None else i + 1), TIP_OFFSET)
+        os.fsync(self.f.fileno())
+
+    def set_id(self, i: int, txid: Optional[str]):
+        """Record (or forget, with None) the txid position `i` was mined as."""
+        index = self._index(i)
+        self._flush()
+        raw = bytes.fromhex(txid) if txid else EMPTY_TXID
+        os.pwrite(
+            self.f.fileno(),
+            TXID.pack(raw, zlib.crc32(raw)),
+            self._offset(index) + TXID_OFFSET,
+        )
+        os.fsync(self.f.fileno())
+
+    def close(self):
+        if not self.f.closed:
+            self.sync()
+            self.f.close()
+
+
+class ChainView(_Positions):
+    """
+    Read-only, memory-mapped view of a chain written by ChainStore.
+
+    Opening it costs the same for any chain length, CTV hashes and template
+    bytes are served as zero-copy memoryview slices of the mapping and every
+    process viewing the same file shares the OS page cache. Txids recorded
+    through a ChainStore after the view was opened are visible right away;
+    positions appended afterwards only show up after refresh().
+    """
+
+    def __init__(self, path: str, chain_max: int):
+        self.path = path
+        self.chain_max = chain_max
+
+        with open(path, "rb") as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._buf = memoryview(self._map)
+
+        if HEADER.unpack_from(self._buf) != (MAGIC, VERSION, chain_max, RECORD_SIZE):
+            self.close()
+            raise ValueError(f"{path} does not hold a chain of size {chain_max}")
+
+        (durable,) = DURABLE.unpack_from(self._buf, DURABLE_OFFSET)
+        available = (len(self._buf) - HEADER_SIZE) // RECORD_SIZE
+        self.count = self._recover(durable, available)
+
+    def _valid(self, index: int) -> bool:
+        offset = HEADER_SIZE + index * RECORD_SIZE
+        (crc,) = struct.unpack_from("<I", self._buf, offset + BODY_SIZE)
+        return zlib.crc32(self._buf[offset : offset + BODY_SIZE]) == crc
+
+    def refresh(self):
+        """Remap the file to pick up positions appended since opening it."""
+        self.close()
+        self.__init__(self.path, self.chain_max)
+
+    def _record(self, i: int) -> memoryview:
+        offset = HEADER_SIZE + self._index(i) * RECORD_SIZE
+        return self._buf[offset : offset + RECORD_SIZE]
+
+    def tmpl_bytes(self, i: int) -> memoryview:
+        record = self._record(i)
+        (tmpl_len,) = struct.unpack_from("<H", record)
+        return record[2 : 2 + tmpl_len]
+
+    def ctv_hash(self, i: int) -> memoryview:
+        return self._record(i)[2 + TMPL_MAX : BODY_SIZE]
+
+    def get_id(self, i: int) -> Optional[str]:
+        record = self._record(i)
+        return _decode_txid(*TXID.unpack_from(record, TXID_OFFSET))
+
+    @property
+    def tip(self) -> Optional[int]:
+        """The last position known to be published, if any."""
+        (tip,) = TIP.unpack_from(self._buf, TIP_OFFSET)
+        return tip - 1 if tip else None
+
+    def __getitem__(self, i: int) -> SpacechainTx:
+        tx = SpacechainTx(tmpl_bytes=bytes(self.tmpl_bytes(i)), id=self.get_id(i))
+        tx._ctv_hashes[0] = bytes(self.ctv_hash(i))
+        return tx
+
+    def close(self):
+        if not self._map.closed:
+            self._buf.release()
+            self._map.close()
+
+
+class ChainIndex:
+    """
+    Persistent hash table from every bare-CTV scriptPubKey of the chain to the
+    position whose CTV hash it commits to.
+
+    An output with such a script belongs to the position right before the
+    one it commits to, so any covenant output seen in the utxo set, a block or
+    the mempool is identified with a single lookup. The table uses open
+    addressing over the first 8 bytes of each CTV hash and stores only
+    positions; hits are confirmed against the chain view.
+    """
+
+    def __init__(self, path: str, view: ChainView):
+        self.path = path
+        self.view = view
+
+        with open(path, "rb") as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._buf = memoryview(self._map)
+
+        magic, chain_max, root, self.slots = INDEX_HEADER.unpack_from(self._buf)
+        if (
+            magic != INDEX_MAGIC
+            or chain_max != view.chain_max
+            or view.lowest != 0
+            or root != view.ctv_hash(0)
+            or len(self._buf) != HEADER_SIZE + self.slots * SLOT.size
+        ):
+            self.close()
+            raise ValueError(f"{path} is not an index of this chain")
+
+    @classmethod
+    def open(cls, path: str, view: ChainView) -> "ChainIndex":
+        """Open the index for a complete chain, building it if needed."""
+        try:
+            return cls(path, view)
+        except (FileNotFoundError, ValueError, struct.error):
+            cls.build(path, view)
+            return cls(path, view)
+
+    @classmethod
+    def build(cls, path: str, view: ChainView):
+        slots = 1 << max(len(view) * 2 - 1, 1).bit_length()
+        table = bytearray(slots * SLOT.size)
+        mask = slots - 1
+
+        # nothing commits to the genesis, so it isn't indexed
+        for i in range(1, view.chain_max + 1):
+            key = int.from_bytes(view.ctv_hash(i)[:8], "little")
+            slot = key & mask
+            while SLOT.unpack_from(table, slot * SLOT.size)[1]:
+                slot = (slot + 1) & mask
+            SLOT.pack_into(table, slot * SLOT.size, key, i + 1)
+
+        # write it next to the final file and swap it in, so a crash never
+        # leaves a half-written index behind
+        tmp = path + ".tmp"
+        with open(tmp, "wb") as f:
+            f.write(
+                INDEX_HEADER.pack(
+                    INDEX_MAGIC, view.chain_max, bytes(view.ctv_hash(0)), slots
+                ).ljust(HEADER_SIZE, b"\0")
+            )
+            f.write(table)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+
+    def lookup(self, ctv_hash: bytes) -> Optional[int]:
+        """The position with the given CTV hash, if it is part of the chain."""
+        key = int.from_bytes(ctv_hash[:8], "little")
+        mask = self.slots - 1
+        slot = key & mask
+        while True:
+            slot_key, pos = SLOT.unpack_from(self._buf, HEADER_SIZE + slot * SLOT.size)
+            if not pos:
+                return None
+            if slot_key == key and self.view.ctv_hash(pos - 1) == ctv_hash:
+                return pos - 1
+            slot = (slot + 1) & mask
+
+    def lookup_script(self, script_pubkey: bytes) -> Optional[int]:
+        """The position a bare-CTV scriptPubKey commits to, if it is ours."""
+        if (
+            len(script_pubkey) != 34
+            or script_pubkey[0] != 32
+            or script_pubkey[33] != OP_CHECKTEMPLATEVERIFY
+        ):
+            return None
+        return self.lookup(bytes(script_pubkey[1:33]))
+
+    def close(self):
+        if not self._map.closed:
+            self._buf.release()
+            self._map.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def _decode_txid(raw: bytes, crc: int) -> Optional[str]:
+    if raw == EMPTY_TXID or zlib.crc32(raw) != crc:
+        return None
+    return raw.hex()
+
+
+class TestChainStore(unittest.TestCase):
+    def test_torn_batch(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "chain")
+            store = ChainStore(path, 9)
+            for i in range(3):
+                store.append(bytes([i]) * 10, bytes([i]) * 32)
+            store.sync()
+            for i in range(3, 7):
+                store.append(bytes([i]) * 10, bytes([i]) * 32)
+            # crash after writing the batch, before sync() made it durable,
+            # with a middle page of it never reaching the disk
+            store._flush()
+            store.f.close()
+            with open(path, "r+b") as f:
+                f.seek(HEADER_SIZE + 4 * RECORD_SIZE)
+                f.write(bytes(RECORD_SIZE))
+
+            with ChainView(path, 9) as view:
+                self.assertEqual(view.lowest, 6)
+            with ChainStore(path, 9) as store:
+                self.assertEqual(store.lowest, 6)
+                self.assertEqual(store.count, 4)
+                self.assertEqual(bytes(store[6].ctv_hash()), bytes([3]) * 32)
+                store.append(b"x", bytes(32))
+            self.assertEqual(os.path.getsize(path), HEADER_SIZE + 5 * RECORD_SIZE)
+            with ChainView(path, 9) as view:
+                self.assertEqual(view.lowest, 5)
@@ -1,5 +1,6 @@
 import sys
 import time
+import hashlib
 import pprint
 import random
 
@@ -12,12 +13,18 @@ from test_framework.messages import (
     CTxWitness,
     CTransaction,
     CTxInWitness,
+    StandardTemplateHashContext,
 )
 from test_framework.script import CScript
 from utils import *
+from chainstore import ChainStore, ChainView, ChainIndex
 
 CHAIN_MAX = 7
 SATS_AMOUNT = 1000
+CHECKPOINT_EVERY = 1000
+LIST_MAX = 20
+CHAIN_FILE = "spacechain.chain"
+INDEX_FILE = "spacechain.index"
 
 wallet = None
 
@@ -25,17 +32,12 @@ wallet = None
 def main():
     with s() as db:
         db["seed"] = db.get("seed") or str(random.random()).encode("utf-8")
-        db["txs"] = db.get("txs") or {}
-
-        current_size = db.get("size")
-        if current_size != CHAIN_MAX:
-            db["size"] = CHAIN_MAX
-            db["txs"] = {}
 
         global wallet
-        wallet = Wallet.generate(db["seed"])
+        wallet = Wallet.generate(db["seed"], db.get("utxos"))
 
     generate_transactions_flow()
+    import_shelve_txids()
     get_money_flow()
 
     pos = find_spacechain_position_flow()
@@ -111,7 +113,8 @@ def mine_next_block_flow(next_pos):
     our_tx.rehash()
 
     # spacechain transaction
-    spc = CTransaction(get_tx(next_pos).template)
+    spc_tmpl = get_tx(next_pos)
+    spc = spc_tmpl.template.copy()
     spc.vin = []
     if next_pos > 0:
         # from the previous spacechain transaction
@@ -138,7 +141,7 @@ def mine_next_block_flow(next_pos):
 
     print(
         cyan(
-            f"    - the actual spacechain covenant transaction (index {next_pos}) with CTV hash equal to {magenta(get_tx(next_pos).ctv_hash().hex())}:"
+            f"    - the actual spacechain covenant transaction (index {next_pos}) with CTV hash equal to {magenta(spc_tmpl.ctv_hash().hex())}:"
         )
     )
     print(f"{white(spc_tx.serialize().hex())}")
@@ -151,8 +154,8 @@ def mine_next_block_flow(next_pos):
     spc_txid = rpc.sendrawtransaction(spc_tx.serialize().hex())
     print(yellow(f"> published {bold(white(spc_txid))}."))
 
-    with s() as db:
-        db["txs"][next_pos].id = spc_txid
+    with chain() as txs:
+        txs.set_id(next_pos, spc_txid)
 
     print()
     print(bold(green(f"CONGRATULATIONS! YOU'VE MINED A SPACECHAIN BLOCK!")))
@@ -166,48 +169,174 @@ def mine_next_block_flow(next_pos):
 def find_spacechain_position_flow():
     print()
     print(yellow(f"> searching for the spacechain tip..."))
-    for i in range(CHAIN_MAX + 1):
-        txid = get_tx(i).id
-        if txid:
-            parent_txid = rpc.getrawtransaction(txid, 2)["vin"][-1]["txid"]
-            spc_blockhash = bytes.fromhex(
-                rpc.getrawtransaction(parent_txid, 2)["vout"][1]["scriptPubKey"]["asm"][
-                    len("OP_RETURN ") :
-                ]
-            ).decode("utf-8")
-            print(f"  - transaction {bold(i)} mined as {bold(green(txid))}")
-            print(f"    with funding parent {bold(white(parent_txid))}")
-            print(f"    and spacechain block hash {bold(blue(spc_blockhash))}")
-            continue
+    with chain_view() as txs, ChainIndex(INDEX_FILE, txs) as index:
+        return find_spacechain_position(txs, index)
 
-        if i == 0:
-            # this is the genesis, so we just assume we're starting a new spacechain
-            print(
-                yellow(
-                    f"> this spacechain has not been bootstrapped yet (at least we don't know about it), so let's start it off"
-                )
+
+def find_spacechain_position(txs, index):
+    if not txs.get_id(0):
+        # this is the genesis, so we just assume we're starting a new spacechain
+        print(
+            yellow(
+                f"> this spacechain has not been bootstrapped yet (at least we don't know about it), so let's start it off"
             )
-            return 0
-
-        # txid for this index not found, check if the previous is spent
-        parent_is_unspent = rpc.gettxout(get_tx(i - 1).id, 0)
-        if parent_is_unspent:
-            print(f"  - transaction {bold(i)} not mined yet")
-            return i
-
-        # the parent is spent, which means this has been published
-        # but we don't know under which txid, so we'll scan the utxo set
-        redeem_script = CScript(
-            [
-                get_tx(i).ctv_hash(),
-                script.OP_CHECKTEMPLATEVERIFY,
-            ]
         )
-        res = rpc.scantxoutset("start", [f"raw({redeem_script.hex()})"])
-        for utxo in res["unspents"]:
-            print(utxo)  # TODO
+        return 0
+
+    # start from the last tip we know about, if it still checks out
+    known = txs.tip
+    if known is None or known not in txs or not txs.get_id(known):
+        known = -1
+
+    tip = locate_tip(txs, index, max(known, 0))
+    if tip is None:
+        return -1
+
+    # only positions we haven't seen before get their details fetched
+    new = {i: txs.get_id(i) for i in range(known + 1, tip + 1)}
+    spc_txs = fetch_txs(txid for txid in new.values() if txid)
+    # the funding parent is always the last input
+    parent_ids = {
+        txid: "%064x" % tx.vin[-1].prevout.hash for txid, tx in spc_txs.items()
+    }
+    parents = fetch_txs(set(parent_ids.values()))
+
+    for i, txid in new.items():
+        if not txid:
+            # the last transaction can't be found by its output, it's an OP_RETURN
+            print(f"  - transaction {bold(i)} mined")
+            continue
+
+        print(f"  - transaction {bold(i)} mined as {bold(green(txid))}")
+        parent_txid = parent_ids.get(txid)
+        payload = spacechain_payload(parents.get(parent_txid))
+        if payload is None:
+            # not one of our funding transactions, or the node lost it
+            continue
+        spc_blockhash = payload.decode("utf-8", errors="replace")
+        print(f"    with funding parent {bold(white(parent_txid))}")
+        print(f"    and spacechain block hash {bold(blue(spc_blockhash))}")
+
+    with chain() as store:
+        store.set_tip(tip)
+
+    if tip == CHAIN_MAX:
+        return -1
 
-    return -1
+    print(f"  - transaction {bold(tip + 1)} not mined yet")
+    return tip + 1
+
+
+def spacechain_payload(funding_tx) -> Optional[bytes]:
+    """The spacechain block hash in the OP_RETURN of a funding transaction."""
+    if funding_tx is None:
+        return None
+    payloads = (op_return_payload(out.scriptPubKey) for out in funding_tx.vout)
+    return next((payload for payload in payloads if payload is not None), None)
+
+
+def locate_tip(txs, index, start):
+    """
+    Returns the position of the last published transaction, given that the
+    one at `start` is published, or None if that can't be established.
+
+    The covenant outputs of the published positions are spent up to the tip,
+    so this gallops over the positions with known txids checking whether
+    their output is spent and then binary-searches the boundary: O(log n)
+    round trips. Positions published by someone else are located through
+    the chain index and recorded before searching on.
+    """
+
+    def is_spent(i):
+        return rpc.gettxout(txs.get_id(i), 0) is None
+
+    while True:
+        # the last transaction has no covenant output left to spend
+        if start == CHAIN_MAX or not is_spent(start):
+            return start
+
+        # gallop until we hit a position that is unknown or unspent
+        lo, step = start, 1
+        while True:
+            hi = min(lo + step, CHAIN_MAX)
+            if hi == CHAIN_MAX or not txs.get_id(hi) or not is_spent(hi):
+                break
+            lo, step = hi, step * 2
+
+        # the boundary is between a spent `lo` and `hi`
+        while hi - lo > 1:
+            mid = (lo + hi) // 2
+            if txs.get_id(mid) and is_spent(mid):
+                lo = mid
+            else:
+                hi = mid
+
+        if txs.get_id(hi):
+            return hi
+
+        # `lo` was spent by a transaction we don't know about
+        if hi == CHAIN_MAX:
+            # nothing else can spend the one before the last
+            return hi
+        seen = locate_covenant_output(index, hi, txs.get_id(lo))
+        start = record_published(seen, hi)
+        if start is None:
+            return None
+
+
+def locate_covenant_output(index, i, spent_txid):
+    """
+    Finds the chain transactions published from position `i` on, given the
+    txid of position `i - 1` which has been spent. Its spenders are in the
+    mempool or in the blocks confirmed since, whose outputs are identified
+    with one chain index lookup each. Returns the transactions seen for each
+    position from `i` on, by position.
+    """
+    seen = {}
+
+    def consider(tx):
+        for out in tx.vout:
+            committed = index.lookup_script(out.scriptPubKey)
+            if committed is not None and committed - 1 >= i:
+                tx.hash or tx.rehash()
+                seen.setdefault(committed - 1, []).append(tx)
+
+    for tx in fetch_txs(rpc.getrawmempool()).values():
+        consider(tx)
+
+    # an unconfirmed transaction only has unconfirmed spenders
+    block_hash = rpc.getrawtransaction(spent_txid, 1).get("blockhash")
+    if block_hash:
+        height = rpc.getblockheader(block_hash)["height"]
+        for block in fetch_blocks(height, rpc.getblockcount() + 1):
+            for tx in block.vtx:
+                consider(tx)
+
+    return seen
+
+
+def record_published(seen, i):
+    """
+    Records the txids of positions `i` onwards out of the transactions
+    `seen` for them, for as long as each one spends the one before. Anyone
+    can pay to a covenant script, so outputs that don't continue the chain
+    are ignored. Returns the last position recorded, or None.
+    """
+    pos = i
+    with chain() as txs:
+        previous = int(txs.get_id(i - 1), 16)
+        while True:
+            # the previous chain transaction is always the first input
+            tx = next(
+                (tx for tx in seen.get(pos, []) if tx.vin[0].prevout.hash == previous),
+                None,
+            )
+            if tx is None:
+                break
+            txs.set_id(pos, tx.hash)
+            previous = tx.sha256
+            pos += 1
+    return pos - 1 if pos > i else None
 
 
 def get_money_flow():
@@ -222,6 +351,8 @@ def get_money_flow():
             )
         )
         wallet.scan()
+        with s() as db:
+            db["utxos"] = wallet.utxos
         print(f"  UTXOs found: {len(wallet.coins)}")
         for utxo in wallet.coins:
             coin = italic(magenta("%064x:%i" % (utxo.outpoint.hash, utxo.outpoint.n)))
@@ -240,75 +371,182 @@ def get_money_flow():
 
 def generate_transactions_flow():
     print(yellow(f"> pregenerating transactions for spacechain covenant string..."))
-    txs = (get_tx(i) for i in range(CHAIN_MAX))
-    for i, tx in enumerate(txs):
-        ctv_hash = cyan(tx.ctv_hash().hex())
-        amount = green(f"{tx.template.vout[0].nValue} sats")
-        print(f"  - [{yellow(i)}] {amount}\n    ctv hash: {ctv_hash}")
+    with chain() as txs:
+        built = 0
+        start = time.time()
+        for i, built, rate in build_chain(txs):
+            print(
+                f"  ~ {built}/{CHAIN_MAX + 1} positions built, now at {bold(i)} ({rate:.0f} positions/s)"
+            )
+        if built:
+            elapsed = time.time() - start
+            print(f"  ~ chain generated in {elapsed:.2f}s")
+
+    with chain_view() as txs:
+        # (re)builds the reverse index from scripts to positions if needed
+        ChainIndex.open(INDEX_FILE, txs).close()
+
+        for i in range(min(CHAIN_MAX, LIST_MAX)):
+            tx = txs[i]
+            ctv_hash = cyan(tx.ctv_hash().hex())
+            amount = green(f"{tx.template.vout[0].nValue} sats")
+            print(f"  - [{yellow(i)}] {amount}\n    ctv hash: {ctv_hash}")
+        if CHAIN_MAX > LIST_MAX:
+            print(f"  - ... and {CHAIN_MAX - LIST_MAX} more")
+
+
+def import_shelve_txids():
+    """
+    Moves the txids of published positions out of the shelve, where earlier
+    versions kept the whole chain, into the chain store. Runs once.
+    """
+    with s() as db:
+        if "txs" not in db:
+            return
+
+        imported = 0
+        # a chain of another length is made of other transactions
+        if db.get("size") == CHAIN_MAX:
+            with chain() as txs:
+                for i, tx in db["txs"].items():
+                    if tx.id and i in txs and txs[i].tmpl_bytes == tx.tmpl_bytes:
+                        txs.set_id(i, tx.id)
+                        imported += 1
+        print(yellow(f"> imported {imported} known txids from the old database"))
+
+        for key in ("txs", "size", "built_from"):
+            db.pop(key, None)
+
+
+def chain() -> ChainStore:
+    return ChainStore(CHAIN_FILE, CHAIN_MAX)
+
+
+def chain_view() -> ChainView:
+    return ChainView(CHAIN_FILE, CHAIN_MAX)
 
 
 def get_tx(i) -> SpacechainTx:
-    id = None
-    with s() as db:
-        if i in db["txs"]:
-            return db["txs"][i]
+    with chain_view() as txs:
+        return txs[i]
+
+
+def build_chain(txs: ChainStore, checkpoint_every=CHECKPOINT_EVERY):
+    """
+    Builds the covenant string back-to-front (each transaction commits to the
+    CTV hash of the next one) into the already open store `txs`.
+
+    Progress is checkpointed to disk every `checkpoint_every` positions, so an
+    interrupted run resumes from the lowest position already built. Yields
+    `(position, positions built in this run, positions per second)` at every
+    checkpoint.
+    """
+    # resume from where the last run stopped, or from the end of the chain
+    i = txs.lowest
+    next_ctv_hash = txs[i].ctv_hash() if i in txs else None
+
+    middle = chain_hasher()
+
+    built = 0
+    start = time.time()
+    while i > 0:
+        i -= 1
+        if i == CHAIN_MAX:
+            tmpl_bytes = last_template().serialize()
+            ctv_hash = SpacechainTx(tmpl_bytes=tmpl_bytes).ctv_hash()
+        elif i == 0:
+            tmpl_bytes = chain_template(i, next_ctv_hash).serialize()
+            ctv_hash = SpacechainTx(tmpl_bytes=tmpl_bytes).ctv_hash()
+        else:
+            tmpl_bytes, ctv_hash = middle(next_ctv_hash)
+
+        txs.append(tmpl_bytes, ctv_hash)
+        next_ctv_hash = ctv_hash
+        built += 1
+
+        if built % checkpoint_every == 0 or i == 0:
+            txs.sync()
+            yield i, built, built / max(time.time() - start, 1e-9)
+
+
+def chain_hasher():
+    """
+    Every position between the genesis and the last one has the same shape and
+    only differs in the CTV hash it commits to, so everything else is hashed
+    once and the SHA-256 midstates are reused. Returns a function mapping the
+    next CTV hash to the `(tmpl_bytes, ctv_hash)` of a middle position.
+    """
+    shape = chain_template(1, bytes(32))
+    ctx = StandardTemplateHashContext(shape)
+    tmpl_bytes = shape.serialize()
+
+    # the committed hash is followed by OP_CHECKTEMPLATEVERIFY in the output
+    # and by nLockTime in the serialized template
+    outputs = shape.vout[0].serialize()
+    outputs_prefix = hashlib.sha256(outputs[:-33])
+    tmpl_prefix, tmpl_suffix = tmpl_bytes[:-37], tmpl_bytes[-5:]
+    op_ctv = bytes([script.OP_CHECKTEMPLATEVERIFY])
+
+    def hash_position(next_ctv_hash: bytes):
+        outputs_hash = outputs_prefix.copy()
+        outputs_hash.update(next_ctv_hash + op_ctv)
+        return (
+            tmpl_prefix + next_ctv_hash + tmpl_suffix,
+            ctx.get_hash(0, outputs_hash.digest()),
+        )
 
-    # the last tx in the chain is always the same
-    if i == CHAIN_MAX:
-        last = CTransaction()
-        last.nVersion = 2
-        last.vin = [
-            # CTV works with blank inputs, we will fill in later
-            CTxIn(nSequence=0),
-            CTxIn(nSequence=0),
-        ]
-        last.vout = [
-            CTxOut(
-                0,
-                # the chain of transactions ends here with an OP_RETURN
-                CScript([script.OP_RETURN, "simple-spacechain".encode("utf-8")]),
-            )
-        ]
-        last.rehash()
+    return hash_position
 
-        with s() as db:
-            db["txs"][i] = SpacechainTx(tmpl_bytes=last.serialize())
-    else:
-        # recursion: we need the next one to calculate its CTV hash and commit here
-        next = get_tx(i + 1)
-
-        tx = CTransaction()
-        tx.nVersion = 2
-        tx.vin = [
-            # CTV works with blank inputs, we will fill in later
-            # one for the previous tx in the chain, the other for fee-bidding
-            CTxIn(nSequence=0),
-            CTxIn(nSequence=0),
-        ]
-
-        # the genesis tx will only have one input, the one we will use to fund it
-        if i == 0:
-            tx.vin = [CTxIn(nSequence=0)]
-
-        tx.vout = [
-            # this output continues the transaction chain
-            CTxOut(
-                SATS_AMOUNT,
-                # bare CTV
-                CScript(
-                    [
-                        next.ctv_hash(),  # CTV hash
-                        script.OP_CHECKTEMPLATEVERIFY,
-                    ]
-                ),
-            ),
-        ]
-        tx.rehash()
 
-        with s() as db:
-            db["txs"][i] = SpacechainTx(tmpl_bytes=tx.serialize())
+def last_template() -> CTransaction:
+    # the last tx in the chain is always the same
+    last = CTransaction()
+    last.nVersion = 2
+    last.vin = [
+        # CTV works with blank inputs, we will fill in later
+        CTxIn(nSequence=0),
+        CTxIn(nSequence=0),
+    ]
+    last.vout = [
+        CTxOut(
+            0,
+            # the chain of transactions ends here with an OP_RETURN
+            CScript([script.OP_RETURN, "simple-spacechain".encode("utf-8")]),
+        )
+    ]
+    last.rehash()
+    return last
+
+
+def chain_template(i, next_ctv_hash: bytes) -> CTransaction:
+    tx = CTransaction()
+    tx.nVersion = 2
+    tx.vin = [
+        # CTV works with blank inputs, we will fill in later
+        # one for the previous tx in the chain, the other for fee-bidding
+        CTxIn(nSequence=0),
+        CTxIn(nSequence=0),
+    ]
+
+    # the genesis tx will only have one input, the one we will use to fund it
+    if i == 0:
+        tx.vin = [CTxIn(nSequence=0)]
 
-    return get_tx(i)
+    tx.vout = [
+        # this output continues the transaction chain
+        CTxOut(
+            SATS_AMOUNT,
+            # bare CTV
+            CScript(
+                [
+                    next_ctv_hash,  # CTV hash of the next tx
+                    script.OP_CHECKTEMPLATEVERIFY,
+                ]
+            ),
+        ),
+    ]
+    tx.rehash()
+    return tx
 
 
 if __name__ == "__main__":
@@ -6,14 +6,16 @@
 WARNING: This code is slow, uses bad randomness, does not properly protect
 keys, and is trivially vulnerable to side channel attacks. Do not use for
 anything but tests."""
+from concurrent.futures import ProcessPoolExecutor
 import csv
 import hashlib
 import hmac
 import os
 import random
+import secrets
 import unittest
 
-from .util import modinv
+from .util import modinv, modinv_batch
 
 def TaggedHash(tag, data):
     ss = hashlib.sha256(tag.encode('utf-8')).digest()
@@ -60,12 +62,81 @@ def modsqrt(a, p):
         return sqrt
     return None
 
+def wnaf(n, w):
+    """Compute the width-w non-adjacent form of a non-negative integer n.
+
+    Returns the digits, least significant first. Every nonzero digit is odd,
+    below 2**(w-1) in absolute value, and followed by at least w-1 zeros."""
+    digits = []
+    while n:
+        if n & 1:
+            d = n & ((1 << w) - 1)
+            if d >= 1 << (w - 1):
+                d -= 1 << w
+            n -= d
+        else:
+            d = 0
+        digits.append(d)
+        n >>= 1
+    return digits
+
+class FixedBaseTable:
+    """Precomputed multiples of a fixed point for fast multiplication.
+
+    Scalars are split in w-bit windows: row i holds the affine multiples
+    j * 2**(w*i) * P for j in 1..2**w-1, so a multiplication takes one mixed
+    addition per nonzero window and no doublings. The table is built on first
+    use."""
+
+    def __init__(self, curve, point, bits=256, w=5):
+        self.curve = curve
+        self.point = point
+        self.bits = bits
+        self.w = w
+        self._rows = None
+
+    @property
+    def rows(self):
+        if self._rows is None:
+            curve = self.curve
+            # build in Jacobian form and normalize all entries at once
+            points = []
+            base = curve.affine(self.point)
+            for _ in range(0, self.bits, self.w):
+                acc = base
+                points.append(acc)
+                for _ in range((1 << self.w) - 2):
+                    acc = curve.add_mixed(acc, base)
+                    points.append(acc)
+                base = curve.affine(curve.add_mixed(acc, base))
+            points = curve.affine_batch(points)
+            n = (1 << self.w) - 1
+            self._rows = [points[i:i + n] for i in range(0, len(points), n)]
+        return self._rows
+
+    def mul(self, n):
+        """Compute n times the point, for 0 <= n < 2**bits."""
+        assert 0 <= n < 1 << self.bits
+        mask = (1 << self.w) - 1
+        r = (0, 1, 0)
+        for row in self.rows:
+            if n & mask:
+                r = self.curve.add_mixed(r, row[(n & mask) - 1])
+            n >>= self.w
+        return r
+
 class EllipticCurve:
     def __init__(self, p, a, b):
         """Initialize elliptic curve y^2 = x^3 + a*x + b over GF(p)."""
         self.p = p
         self.a = a % p
         self.b = b % p
+        # FixedBaseTable by point, for the points mul() sees most often
+        self.fixed_bases = {}
+
+    def add_fixed_base(self, point, **kwargs):
+        """Have mul() use a precomputed table for multiples of point."""
+        self.fixed_bases[point] = FixedBaseTable(self, point, **kwargs)
 
     def affine(self, p1):
         """Convert a Jacobian point tuple p1 to affine form, or None if at infinity.
@@ -74,7 +145,20 @@ class EllipticCurve:
         x1, y1, z1 = p1
         if z1 == 0:
             return None
-        inv = modinv(z1, self.p)
+        if z1 == 1:
+            return p1
+        return self._normalize(p1, pow(z1, -1, self.p))
+
+    def affine_batch(self, ps):
+        """Convert a list of Jacobian point tuples to affine form (None for points at infinity),
+        sharing a single field inversion between them."""
+        finite = [p1 for p1 in ps if p1[2] != 0]
+        invs = iter(modinv_batch([p1[2] for p1 in finite], self.p)) if finite else None
+        return [self._normalize(p1, next(invs)) if p1[2] != 0 else None for p1 in ps]
+
+    def _normalize(self, p1, inv):
+        """Convert a Jacobian point tuple p1 to affine form given the inverse of its Z."""
+        x1, y1, _ = p1
         inv_2 = (inv**2) % self.p
         inv_3 = (inv_2 * inv) % self.p
         return ((inv_2 * x1) % self.p, (inv_3 * y1) % self.p, 1)
@@ -199,24 +283,53 @@ class EllipticCurve:
         z3 = (h*z1*z2) % self.p
         return (x3, y3, z3)
 
-    def mul(self, ps):
+    def mul(self, ps, w=5):
         """Compute a (multi) point multiplication
 
-        ps is a list of (Jacobian tuple, scalar) pairs.
+        ps is a list of (Jacobian tuple, scalar) pairs. Points with a fixed
+        base table are multiplied through it, the others together with
+        width-w NAF scalars that share their doublings (Straus' method), their
+        odd multiples normalized to affine form in one go.
         """
         r = (0, 1, 0)
-        for i in range(255, -1, -1):
-            r = self.double(r)
-            for (p, n) in ps:
-                if ((n >> i) & 1):
-                    r = self.add(r, p)
-        return r
+        variable = []
+        for (p, n) in ps:
+            table = self.fixed_bases.get(p)
+            if table is not None and n < 1 << table.bits:
+                r = self.add(r, table.mul(n))
+            elif n and p[2] != 0:
+                variable.append((p, n))
+
+        count = 1 << (w - 2)
+        multiples = self.affine_batch([m for (p, _) in variable for m in self.odd_multiples(p, w)])
+        nafs = [(multiples[i * count:(i + 1) * count], wnaf(n, w)) for i, (_, n) in enumerate(variable)]
+
+        acc = (0, 1, 0)
+        for i in range(max((len(digits) for _, digits in nafs), default=0) - 1, -1, -1):
+            acc = self.double(acc)
+            for (multiples, digits) in nafs:
+                if i < len(digits) and digits[i]:
+                    d = digits[i]
+                    if d > 0:
+                        acc = self.add(acc, multiples[d >> 1])
+                    else:
+                        acc = self.add(acc, self.negate(multiples[-d >> 1]))
+        return self.add(r, acc)
+
+    def odd_multiples(self, p1, w):
+        """Compute [p1, 3*p1, 5*p1, ..., (2**(w-1)-1)*p1] as Jacobian tuples."""
+        multiples = [p1]
+        p1_2 = self.double(p1)
+        for _ in range((1 << (w - 2)) - 1):
+            multiples.append(self.add(multiples[-1], p1_2))
+        return multiples
 
 SECP256K1_FIELD_SIZE = 2**256 - 2**32 - 977
 SECP256K1 = EllipticCurve(SECP256K1_FIELD_SIZE, 0, 7)
 SECP256K1_G = (0x79BE667EF9DCBBAC55A06295CE870B07029BFCDB2DCE28D959F2815B16F81798, 0x483ADA7726A3C4655DA4FBFC0E1108A8FD17B448A68554199C47D08FFB10D4B8, 1)
 SECP256K1_ORDER = 0xFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFEBAAEDCE6AF48A03BBFD25E8CD0364141
 SECP256K1_ORDER_HALF = SECP256K1_ORDER // 2
+SECP256K1.add_fixed_base(SECP256K1_G)
 
 class ECPubKey():
     """A secp256k1 public key"""
@@ -323,6 +436,26 @@ class ECPubKey():
             return False
         return True
 
+# Below this many signatures, verify_ecdsa_batch doesn't start worker processes
+ECDSA_BATCH_MIN_PARALLEL = 64
+
+def _verify_ecdsa(item):
+    pubkey, sig, msg, low_s = item
+    return pubkey.verify_ecdsa(sig, msg, low_s)
+
+def verify_ecdsa_batch(batch, low_s=True, max_workers=None):
+    """Verify a list of (ECPubKey, sig, msg) ECDSA signatures.
+
+    The signatures are checked independently, spread over a pool of worker
+    processes for larger batches. Returns the result of each, in order."""
+    items = [(pubkey, sig, msg, low_s) for (pubkey, sig, msg) in batch]
+    workers = max_workers or os.cpu_count() or 1
+    if len(items) < ECDSA_BATCH_MIN_PARALLEL or workers == 1:
+        return [_verify_ecdsa(item) for item in items]
+    with ProcessPoolExecutor(workers) as executor:
+        chunksize = max(1, len(items) // (4 * workers))
+        return list(executor.map(_verify_ecdsa, items, chunksize=chunksize))
+
 def generate_privkey():
     """Generate a valid random 32-byte private key."""
     return random.randrange(1, SECP256K1_ORDER).to_bytes(32, 'big')
@@ -403,6 +536,22 @@ class ECKey():
         sb = s.to_bytes((s.bit_length() + 8) // 8, 'big')
         return b'\x30' + bytes([4 + len(rb) + len(sb), 2, len(rb)]) + rb + bytes([2, len(sb)]) + sb
 
+def compute_xonly_pubkeys(keys):
+    """Compute the x-only public keys of many private keys, as compute_xonly_pubkey does
+    for one, sharing a single field inversion between them."""
+    points = []
+    for key in keys:
+        assert len(key) == 32
+        x = int.from_bytes(key, 'big')
+        points.append(SECP256K1.mul([(SECP256K1_G, x)]) if 0 < x < SECP256K1_ORDER else (0, 1, 0))
+    result = []
+    for P in SECP256K1.affine_batch(points):
+        if P is None:
+            result.append((None, None))
+        else:
+            result.append((P[0].to_bytes(32, 'big'), not SECP256K1.has_even_y(P)))
+    return result
+
 def compute_xonly_pubkey(key):
     """Compute an x-only (32 byte) public key from a (32 byte) private key.
 
@@ -486,6 +635,69 @@ def verify_schnorr(key, sig, msg):
         return False
     return True
 
+def _schnorr_batch_terms(key, sig, msg):
+    """Parse a BIP340 signature into the (P, R, s, e) of its equation
+    s*G = R + e*P, or None if it can't be valid whatever the batch."""
+    assert len(key) == 32
+    assert len(msg) == 32
+    assert len(sig) == 64
+
+    x_coord = int.from_bytes(key, 'big')
+    if x_coord == 0 or x_coord >= SECP256K1_FIELD_SIZE:
+        return None
+    P = SECP256K1.lift_x(x_coord)
+    if P is None:
+        return None
+    r = int.from_bytes(sig[0:32], 'big')
+    if r >= SECP256K1_FIELD_SIZE:
+        return None
+    R = SECP256K1.lift_x(r)
+    if R is None:
+        return None
+    s = int.from_bytes(sig[32:64], 'big')
+    if s >= SECP256K1_ORDER:
+        return None
+    e = int.from_bytes(TaggedHash("BIP0340/challenge", sig[0:32] + key + msg), 'big') % SECP256K1_ORDER
+    return (P, R, s, e)
+
+def _schnorr_batch_holds(terms):
+    """Check a random linear combination of the equations of terms:
+    (sum a_i*s_i)*G - sum a_i*R_i - sum (a_i*e_i)*P_i is the point at infinity.
+
+    The a_i must be unpredictable to whoever chose the signatures, so they
+    come from the OS CSPRNG rather than the random module."""
+    ps = []
+    s_sum = 0
+    for i, (P, R, s, e) in enumerate(terms):
+        a = 1 if i == 0 else 1 + secrets.randbelow(SECP256K1_ORDER - 1)
+        s_sum += a * s
+        ps.append((R, a))
+        ps.append((P, a * e % SECP256K1_ORDER))
+    ps.append((SECP256K1_G, -s_sum % SECP256K1_ORDER))
+    return SECP256K1.mul(ps)[2] == 0
+
+def verify_schnorr_batch(batch):
+    """Verify a list of (key, sig, msg) BIP340 signatures together.
+
+    All equations are checked at once as a random linear combination, with a
+    single multi-scalar multiplication. When that fails, the batch is split
+    in halves until the invalid signatures are found. Returns the result of
+    each signature, in order."""
+    terms = [_schnorr_batch_terms(*item) for item in batch]
+    results = [t is not None for t in terms]
+
+    def check(indices):
+        if not indices or _schnorr_batch_holds([terms[i] for i in indices]):
+            return
+        if len(indices) == 1:
+            results[indices[0]] = False
+            return
+        check(indices[:len(indices) // 2])
+        check(indices[len(indices) // 2:])
+
+    check([i for i, t in enumerate(terms) if t is not None])
+    return results
+
 def sign_schnorr(key, msg, aux=None, flip_p=False, flip_r=False):
     """Create a Schnorr signature (see BIP 340)."""
 
@@ -511,6 +723,23 @@ def sign_schnorr(key, msg, aux=None, flip_p=False, flip_r=False):
     return R[0].to_bytes(32, 'big') + ((k + e * sec) % SECP256K1_ORDER).to_bytes(32, 'big')
 
 class TestFrameworkKey(unittest.TestCase):
+    def test_mul(self):
+        """Test the table and wNAF multiplications against double-and-add."""
+        def naive_mul(ps):
+            r = (0, 1, 0)
+            for i in range(256, -1, -1):
+                r = SECP256K1.double(r)
+                for (p, n) in ps:
+                    if ((n >> i) & 1):
+                        r = SECP256K1.add(r, p)
+            return r
+
+        P = SECP256K1.mul([(SECP256K1_G, random.randrange(1, SECP256K1_ORDER))])
+        scalars = [0, 1, 2, 31, 32, SECP256K1_ORDER - 1, SECP256K1_ORDER, 2**256 - 1] + [random.randrange(2**256) for _ in range(4)]
+        for n in scalars:
+            for ps in ([(SECP256K1_G, n)], [(P, n)], [(SECP256K1_G, n), (P, (SECP256K1_ORDER - n) % SECP256K1_ORDER)]):
+                self.assertEqual(SECP256K1.affine(SECP256K1.mul(ps)), SECP256K1.affine(naive_mul(ps)))
+
     def test_schnorr(self):
         """Test the Python Schnorr implementation."""
         byte_arrays = [generate_privkey() for _ in range(3)] + [v.to_bytes(32, 'big') for v in [0, SECP256K1_ORDER - 1, SECP256K1_ORDER, 2**256 - 1]]
@@ -519,6 +748,7 @@ class TestFrameworkKey(unittest.TestCase):
             pubkey, _ = compute_xonly_pubkey(privkey)
             if pubkey is not None:
                 keys[privkey] = pubkey
+        self.assertEqual(compute_xonly_pubkeys(byte_arrays), [compute_xonly_pubkey(privkey) for privkey in byte_arrays])
         for msg in byte_arrays:  # test every combination of message, signing key, verification key
             for sign_privkey, _ in keys.items():
                 sig = sign_schnorr(sign_privkey, msg)
@@ -530,6 +760,46 @@ class TestFrameworkKey(unittest.TestCase):
                         sig = bytes(sig)
                     self.assertFalse(verify_schnorr(verify_pubkey, sig, msg))
 
+    def test_batch_verification(self):
+        """Test batch verification against verifying one signature at a time."""
+        keys = [generate_privkey() for _ in range(4)]
+        msgs = [random.randrange(2**256).to_bytes(32, 'big') for _ in range(4)]
+        schnorr = [(compute_xonly_pubkey(k)[0], sign_schnorr(k, m), m) for k in keys for m in msgs]
+        ecdsa = []
+        for k in keys:
+            key = ECKey()
+            key.set(k, True)
+            ecdsa += [(key.get_pubkey(), key.sign_ecdsa(m), m) for m in msgs]
+        bad = set()
+        for damaged in ([], [0], [3, 7, 15]):
+            bad.update(damaged)
+            for i in damaged:
+                pubkey, sig, msg = schnorr[i]
+                schnorr[i] = (pubkey, sig, msg[::-1])
+                pubkey, sig, msg = ecdsa[i]
+                ecdsa[i] = (pubkey, sig, msg[::-1])
+            self.assertEqual(verify_schnorr_batch(schnorr), [verify_schnorr(*item) for item in schnorr])
+            self.assertEqual(verify_schnorr_batch(schnorr), [i not in bad for i in range(len(schnorr))])
+            self.assertEqual(verify_ecdsa_batch(ecdsa), [i not in bad for i in range(len(ecdsa))])
+
+    def test_ecdsa_batch_verification_parallel(self):
+        """Test ECDSA batch verification spread over worker processes."""
+        keys = [generate_privkey() for _ in range(4)]
+        msgs = [random.randrange(2**256).to_bytes(32, 'big') for _ in range(ECDSA_BATCH_MIN_PARALLEL // 4 + 3)]
+        ecdsa = []
+        for k in keys:
+            key = ECKey()
+            key.set(k, True)
+            ecdsa += [(key.get_pubkey(), key.sign_ecdsa(m), m) for m in msgs]
+        self.assertGreaterEqual(len(ecdsa), ECDSA_BATCH_MIN_PARALLEL)
+        bad = {0, 5, 31, 32, len(ecdsa) - 1}
+        for i in bad:
+            pubkey, sig, msg = ecdsa[i]
+            ecdsa[i] = (pubkey, sig, msg[::-1])
+        expected = [i not in bad for i in range(len(ecdsa))]
+        self.assertEqual(verify_ecdsa_batch(ecdsa, max_workers=2), expected)
+        self.assertEqual(verify_ecdsa_batch(ecdsa, max_workers=1), expected)
+
     def test_schnorr_testvectors(self):
         """Implement the BIP340 test vectors (read from bip340_test_vectors.csv)."""
         num_tests = 0
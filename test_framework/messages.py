@@ -19,14 +19,14 @@ Classes use __slots__ to ensure extraneous attributes aren't accidentally added
 by tests, compromising their intended effect.
 """
 from base64 import b32decode, b32encode
-import copy
 import hashlib
-from io import BytesIO
+from io import BufferedReader, BytesIO
 import math
 import random
 import socket
 import struct
 import time
+import unittest
 
 from test_framework.siphash import siphash256
 from test_framework.util import assert_equal
@@ -69,6 +69,8 @@ FILTER_TYPE_BASIC = 0
 
 WITNESS_SCALE_FACTOR = 4
 
+UINT256_MASK = (1 << 256) - 1
+
 
 def sha256(s):
     return hashlib.sha256(s).digest()
@@ -91,6 +93,17 @@ def ser_compact_size(l):
     return r
 
 
+def compact_size_len(l):
+    """Length of ser_compact_size(l)."""
+    if l < 253:
+        return 1
+    elif l < 0x10000:
+        return 3
+    elif l < 0x100000000:
+        return 5
+    return 9
+
+
 def deser_compact_size(f):
     nit = struct.unpack("<B", f.read(1))[0]
     if nit == 253:
@@ -120,11 +133,7 @@ def deser_uint256(f):
 
 
 def ser_uint256(u):
-    rs = b""
-    for _ in range(8):
-        rs += struct.pack("<I", u & 0xFFFFFFFF)
-        u >>= 32
-    return rs
+    return (u & UINT256_MASK).to_bytes(32, "little")
 
 
 def uint256_from_str(s):
@@ -160,13 +169,22 @@ def deser_vector(f, c, deser_function_name=None):
 # entries in the vector (we use this for serializing the vector of transactions
 # for a witness block).
 def ser_vector(l, ser_function_name=None):
-    r = ser_compact_size(len(l))
+    r = bytearray(ser_compact_size(len(l)))
     for i in l:
         if ser_function_name:
             r += getattr(i, ser_function_name)()
         else:
             r += i.serialize()
-    return r
+    return bytes(r)
+
+
+# Objects with a serialize_into(r) method append their serialization to the
+# bytearray r, so that nested objects (like the transactions of a block) are
+# all written into one buffer instead of being concatenated level by level.
+def serialize_with(obj, *args):
+    r = bytearray()
+    obj.serialize_into(r, *args)
+    return bytes(r)
 
 
 def deser_uint256_vector(f):
@@ -179,10 +197,7 @@ def deser_uint256_vector(f):
 
 
 def ser_uint256_vector(l):
-    r = ser_compact_size(len(l))
-    for i in l:
-        r += ser_uint256(i)
-    return r
+    return ser_compact_size(len(l)) + b"".join(ser_uint256(i) for i in l)
 
 
 def deser_string_vector(f):
@@ -195,9 +210,163 @@ def deser_string_vector(f):
 
 
 def ser_string_vector(l):
-    r = ser_compact_size(len(l))
+    r = bytearray(ser_compact_size(len(l)))
     for sv in l:
-        r += ser_string(sv)
+        r += ser_compact_size(len(sv))
+        r += sv
+    return bytes(r)
+
+
+class ByteCursor:
+    """Read position over a bytes-like object, for deserializing without
+    going through a stream.
+
+    Fields are decoded in place with struct.unpack_from/int.from_bytes, and
+    only the byte strings kept by the deserialized objects are copied. It
+    also has a stream-like read(), so deserialize(f) methods work on it too.
+    """
+
+    __slots__ = ("data", "pos")
+
+    def __init__(self, data, pos=0):
+        self.data = memoryview(data)
+        self.pos = pos
+
+    def read(self, n):
+        r = bytes(self.data[self.pos : self.pos + n])
+        self.pos += len(r)
+        return r
+
+    def unpack(self, fmt):
+        r = fmt.unpack_from(self.data, self.pos)
+        self.pos += fmt.size
+        return r
+
+    def compact_size(self):
+        nit = self.data[self.pos]
+        self.pos += 1
+        if nit == 253:
+            nit = self.unpack(_UINT16)[0]
+        elif nit == 254:
+            nit = self.unpack(_UINT32)[0]
+        elif nit == 255:
+            nit = self.unpack(_UINT64)[0]
+        return nit
+
+    def string(self):
+        nit = self.compact_size()
+        return self.read(nit)
+
+    def uint256(self):
+        r = int.from_bytes(self.data[self.pos : self.pos + 32], "little")
+        self.pos += 32
+        return r
+
+
+_UINT16 = struct.Struct("<H")
+_UINT32 = struct.Struct("<I")
+_INT32 = struct.Struct("<i")
+_UINT64 = struct.Struct("<Q")
+_INT64 = struct.Struct("<q")
+
+
+def deserialize_with_cursor(obj, f):
+    """Deserialize obj with obj.deserialize_cursor() from f, if f is a
+    BytesIO or a ByteCursor, falling back to obj.deserialize(f) otherwise.
+    Either way f is left right after the serialization."""
+    if isinstance(f, ByteCursor):
+        obj.deserialize_cursor(f)
+    elif isinstance(f, BytesIO):
+        buf = f.getbuffer()
+        try:
+            c = ByteCursor(buf, f.tell())
+            obj.deserialize_cursor(c)
+            f.seek(c.pos)
+            c.data.release()
+        finally:
+            buf.release()
+    else:
+        obj.deserialize(f)
+    return obj
+
+
+def deser_vector_cursor(c, cls):
+    r = []
+    for _ in range(c.compact_size()):
+        t = cls()
+        t.deserialize_cursor(c)
+        r.append(t)
+    return r
+
+
+# The transaction parts below are read in tight loops over the buffer, as
+# they make up most of a block, and built without running __init__. Lengths
+# below 253 are the single byte case of compact sizes.
+
+
+def _deser_txins_cursor(c):
+    data = c.data
+    r = []
+    for _ in range(c.compact_size()):
+        pos = c.pos
+        prevout = COutPoint.__new__(COutPoint)
+        prevout.hash = int.from_bytes(data[pos : pos + 32], "little")
+        prevout.n = _UINT32.unpack_from(data, pos + 32)[0]
+        nit = data[pos + 36]
+        if nit < 253:
+            pos += 37
+        else:
+            c.pos = pos + 36
+            nit = c.compact_size()
+            pos = c.pos
+        txin = CTxIn.__new__(CTxIn)
+        txin.prevout = prevout
+        txin.scriptSig = bytes(data[pos : pos + nit])
+        pos += nit
+        txin.nSequence = _UINT32.unpack_from(data, pos)[0]
+        c.pos = pos + 4
+        r.append(txin)
+    return r
+
+
+def _deser_txouts_cursor(c):
+    data = c.data
+    r = []
+    for _ in range(c.compact_size()):
+        pos = c.pos
+        txout = CTxOut.__new__(CTxOut)
+        txout.nValue = _INT64.unpack_from(data, pos)[0]
+        nit = data[pos + 8]
+        if nit < 253:
+            pos += 9
+        else:
+            c.pos = pos + 8
+            nit = c.compact_size()
+            pos = c.pos
+        txout.scriptPubKey = bytes(data[pos : pos + nit])
+        c.pos = pos + nit
+        r.append(txout)
+    return r
+
+
+def _deser_witness_cursor(c, n):
+    data = c.data
+    r = []
+    for _ in range(n):
+        stack = []
+        for _ in range(c.compact_size()):
+            pos = c.pos
+            nit = data[pos]
+            if nit < 253:
+                pos += 1
+            else:
+                nit = c.compact_size()
+                pos = c.pos
+            stack.append(bytes(data[pos : pos + nit]))
+            c.pos = pos + nit
+        inwit = CTxInWitness()
+        inwit.scriptWitness.stack = stack
+        r.append(inwit)
     return r
 
 
@@ -207,7 +376,11 @@ def from_hex(obj, hex_string):
     Note that there is no complementary helper like e.g. `to_hex` for the
     inverse operation. To serialize a message object to a hex string, simply
     use obj.serialize().hex()"""
-    obj.deserialize(BytesIO(bytes.fromhex(hex_string)))
+    data = bytes.fromhex(hex_string)
+    if hasattr(obj, "deserialize_cursor"):
+        obj.deserialize_cursor(ByteCursor(data))
+    else:
+        obj.deserialize(BytesIO(data))
     return obj
 
 
@@ -393,10 +566,14 @@ class COutPoint:
         self.n = struct.unpack("<I", f.read(4))[0]
 
     def serialize(self):
-        r = b""
-        r += ser_uint256(self.hash)
-        r += struct.pack("<I", self.n)
-        return r
+        return ser_uint256(self.hash) + struct.pack("<I", self.n)
+
+    def serialize_into(self, r):
+        r += (self.hash & UINT256_MASK).to_bytes(32, "little")
+        r += _UINT32.pack(self.n)
+
+    def copy(self):
+        return COutPoint(self.hash, self.n)
 
     def __repr__(self):
         return "COutPoint(hash=%064x n=%i)" % (self.hash, self.n)
@@ -420,11 +597,21 @@ class CTxIn:
         self.nSequence = struct.unpack("<I", f.read(4))[0]
 
     def serialize(self):
-        r = b""
-        r += self.prevout.serialize()
-        r += ser_string(self.scriptSig)
-        r += struct.pack("<I", self.nSequence)
-        return r
+        return serialize_with(self)
+
+    def serialize_into(self, r):
+        self.prevout.serialize_into(r)
+        r += ser_compact_size(len(self.scriptSig))
+        r += self.scriptSig
+        r += _UINT32.pack(self.nSequence)
+
+    def serialized_size(self):
+        # prevout and nSequence are fixed size
+        return 40 + compact_size_len(len(self.scriptSig)) + len(self.scriptSig)
+
+    def copy(self):
+        # scriptSig is immutable and shared
+        return CTxIn(self.prevout.copy(), self.scriptSig, self.nSequence)
 
     def __repr__(self):
         return "CTxIn(prevout=%s scriptSig=%s nSequence=%i)" % (
@@ -446,10 +633,19 @@ class CTxOut:
         self.scriptPubKey = deser_string(f)
 
     def serialize(self):
-        r = b""
-        r += struct.pack("<q", self.nValue)
-        r += ser_string(self.scriptPubKey)
-        return r
+        return serialize_with(self)
+
+    def serialize_into(self, r):
+        r += _INT64.pack(self.nValue)
+        r += ser_compact_size(len(self.scriptPubKey))
+        r += self.scriptPubKey
+
+    def serialized_size(self):
+        return 8 + compact_size_len(len(self.scriptPubKey)) + len(self.scriptPubKey)
+
+    def copy(self):
+        # scriptPubKey is immutable and shared
+        return CTxOut(self.nValue, self.scriptPubKey)
 
     def __repr__(self):
         return "CTxOut(nValue=%i.%08i scriptPubKey=%s)" % (
@@ -487,6 +683,25 @@ class CTxInWitness:
     def serialize(self):
         return ser_string_vector(self.scriptWitness.stack)
 
+    def serialize_into(self, r):
+        stack = self.scriptWitness.stack
+        r += ser_compact_size(len(stack))
+        for sv in stack:
+            r += ser_compact_size(len(sv))
+            r += sv
+
+    def serialized_size(self):
+        stack = self.scriptWitness.stack
+        return compact_size_len(len(stack)) + sum(
+            compact_size_len(len(sv)) + len(sv) for sv in stack
+        )
+
+    def copy(self):
+        # a new stack holding the same (immutable) items
+        w = CTxInWitness()
+        w.scriptWitness.stack = list(self.scriptWitness.stack)
+        return w
+
     def __repr__(self):
         return repr(self.scriptWitness)
 
@@ -505,13 +720,19 @@ class CTxWitness:
             self.vtxinwit[i].deserialize(f)
 
     def serialize(self):
-        r = b""
+        return serialize_with(self)
+
+    def serialize_into(self, r):
         # This is different than the usual vector serialization --
         # we omit the length of the vector, which is required to be
         # the same length as the transaction's vin vector.
         for x in self.vtxinwit:
-            r += x.serialize()
-        return r
+            x.serialize_into(r)
+
+    def copy(self):
+        w = CTxWitness()
+        w.vtxinwit = [x.copy() for x in self.vtxinwit]
+        return w
 
     def __repr__(self):
         return "CTxWitness(%s)" % (";".join([repr(x) for x in self.vtxinwit]))
@@ -524,9 +745,27 @@ class CTxWitness:
 
 
 class CTransaction:
-    __slots__ = ("hash", "nLockTime", "nVersion", "sha256", "vin", "vout", "wit")
+    """A transaction. serialize(), calc_sha256(), rehash() and getwtxid()
+    always work from the current fields, serializing once each. So do
+    get_weight() and get_vsize(), without serializing at all, unless the
+    transaction only changed through add_input(), add_output() and
+    add_witness_item() since they last ran: the sizes those kept up to date
+    are used then. Call invalidate() after modifying fields directly in
+    between."""
+    __slots__ = (
+        "_sizes",
+        "hash",
+        "nLockTime",
+        "nVersion",
+        "sha256",
+        "vin",
+        "vout",
+        "wit",
+    )
 
     def __init__(self, tx=None):
+        # (size without witness, bytes the witness adds, kept up to date)
+        self._sizes = None
         if tx is None:
             self.nVersion = 2
             self.vin = []
@@ -537,14 +776,26 @@ class CTransaction:
             self.hash = None
         else:
             self.nVersion = tx.nVersion
-            self.vin = copy.deepcopy(tx.vin)
-            self.vout = copy.deepcopy(tx.vout)
+            self.vin = [txin.copy() for txin in tx.vin]
+            self.vout = [txout.copy() for txout in tx.vout]
             self.nLockTime = tx.nLockTime
             self.sha256 = tx.sha256
             self.hash = tx.hash
-            self.wit = copy.deepcopy(tx.wit)
+            self.wit = tx.wit.copy()
+
+    def copy(self):
+        """A copy sharing only the immutable scripts and witness items."""
+        return CTransaction(self)
+
+    def invalidate(self):
+        """Forget the sizes kept up to date by add_input(), add_output() and
+        add_witness_item(), after modifying fields directly."""
+        self._sizes = None
 
     def deserialize(self, f):
+        if isinstance(f, (BytesIO, ByteCursor)):
+            deserialize_with_cursor(self, f)
+            return
         self.nVersion = struct.unpack("<i", f.read(4))[0]
         self.vin = deser_vector(f, CTxIn)
         flags = 0
@@ -565,50 +816,67 @@ class CTransaction:
         self.nLockTime = struct.unpack("<I", f.read(4))[0]
         self.sha256 = None
         self.hash = None
+        self._sizes = None
+
+    def deserialize_cursor(self, c):
+        """Same as deserialize(), reading from a ByteCursor."""
+        self.nVersion = c.unpack(_INT32)[0]
+        self.vin = _deser_txins_cursor(c)
+        flags = 0
+        if len(self.vin) == 0:
+            flags = c.data[c.pos]
+            c.pos += 1
+            # Not sure why flags can't be zero, but this
+            # matches the implementation in bitcoind
+            if flags != 0:
+                self.vin = _deser_txins_cursor(c)
+                self.vout = _deser_txouts_cursor(c)
+        else:
+            self.vout = _deser_txouts_cursor(c)
+        self.wit = CTxWitness()
+        if flags != 0:
+            self.wit.vtxinwit = _deser_witness_cursor(c, len(self.vin))
+        self.nLockTime = c.unpack(_UINT32)[0]
+        self.sha256 = None
+        self.hash = None
+        self._sizes = None
 
     def serialize_without_witness(self):
-        r = b""
-        r += struct.pack("<i", self.nVersion)
-        r += ser_vector(self.vin)
-        r += ser_vector(self.vout)
-        r += struct.pack("<I", self.nLockTime)
-        return r
+        return serialize_with(self, False)
 
     def get_standard_template_hash(self, nIn):
-        r = b""
-        r += struct.pack("<i", self.nVersion)
-        r += struct.pack("<I", self.nLockTime)
-        if any(inp.scriptSig for inp in self.vin):
-            r += sha256(b"".join(ser_string(inp.scriptSig) for inp in self.vin))
-        r += struct.pack("<I", len(self.vin))
-        r += sha256(b"".join(struct.pack("<I", inp.nSequence) for inp in self.vin))
-        r += struct.pack("<I", len(self.vout))
-        r += sha256(b"".join(out.serialize() for out in self.vout))
-        r += struct.pack("<I", nIn)
-        return sha256(r)
+        return StandardTemplateHashContext(self).get_hash(nIn)
+
+    def get_standard_template_hashes(self):
+        return StandardTemplateHashContext(self).get_hashes()
 
     # Only serialize with witness when explicitly called for
     def serialize_with_witness(self):
+        return serialize_with(self, True)
+
+    def serialize_into(self, r, with_witness=True):
         flags = 0
-        if not self.wit.is_null():
+        if with_witness and not self.wit.is_null():
             flags |= 1
-        r = b""
-        r += struct.pack("<i", self.nVersion)
+        r += _INT32.pack(self.nVersion)
         if flags:
-            dummy = []
-            r += ser_vector(dummy)
+            # empty vin marker
+            r += b"\x00"
             r += struct.pack("<B", flags)
-        r += ser_vector(self.vin)
-        r += ser_vector(self.vout)
+        r += ser_compact_size(len(self.vin))
+        for txin in self.vin:
+            txin.serialize_into(r)
+        r += ser_compact_size(len(self.vout))
+        for txout in self.vout:
+            txout.serialize_into(r)
         if flags & 1:
             if len(self.wit.vtxinwit) != len(self.vin):
                 # vtxinwit must have the same length as vin
                 self.wit.vtxinwit = self.wit.vtxinwit[: len(self.vin)]
                 for _ in range(len(self.wit.vtxinwit), len(self.vin)):
                     self.wit.vtxinwit.append(CTxInWitness())
-            r += self.wit.serialize()
-        r += struct.pack("<I", self.nLockTime)
-        return r
+            self.wit.serialize_into(r)
+        r += _UINT32.pack(self.nLockTime)
 
     # Regular serialization is with witness -- must explicitly
     # call serialize_without_witness to exclude witness data.
@@ -631,9 +899,10 @@ class CTransaction:
             # Don't cache the result, just return it
             return uint256_from_str(hash256(self.serialize_with_witness()))
 
+        txid = hash256(self.serialize_without_witness())
         if self.sha256 is None:
-            self.sha256 = uint256_from_str(hash256(self.serialize_without_witness()))
-        self.hash = hash256(self.serialize_without_witness())[::-1].hex()
+            self.sha256 = uint256_from_str(txid)
+        self.hash = txid[::-1].hex()
 
     def is_valid(self):
         self.calc_sha256()
@@ -642,12 +911,84 @@ class CTransaction:
                 return False
         return True
 
+    def add_input(self, txin):
+        """Append an input, keeping the cached sizes up to date."""
+        sizes = self._sizes
+        self.vin.append(txin)
+        self._sizes = None
+        n = len(self.vin)
+        # an input past the end of vtxinwit gets an empty witness
+        if sizes and len(self.wit.vtxinwit) < n:
+            stripped, witness, _ = sizes
+            stripped += txin.serialized_size()
+            stripped += compact_size_len(n) - compact_size_len(n - 1)
+            self._sizes = (stripped, witness + 1 if witness else 0, True)
+
+    def add_output(self, txout):
+        """Append an output, keeping the cached sizes up to date."""
+        sizes = self._sizes
+        self.vout.append(txout)
+        self._sizes = None
+        n = len(self.vout)
+        if sizes:
+            stripped, witness, _ = sizes
+            stripped += txout.serialized_size()
+            stripped += compact_size_len(n) - compact_size_len(n - 1)
+            self._sizes = (stripped, witness, True)
+
+    def add_witness_item(self, nIn, item):
+        """Push an item on the witness stack of input nIn, keeping the
+        cached sizes up to date."""
+        sizes = self._sizes
+        vtxinwit = self.wit.vtxinwit
+        for _ in range(len(vtxinwit), nIn + 1):
+            vtxinwit.append(CTxInWitness())
+        stack = vtxinwit[nIn].scriptWitness.stack
+        stack.append(item)
+        self._sizes = None
+        # the first witness item adds the marker and flag, recompute then
+        if sizes and sizes[1] and nIn < len(self.vin):
+            stripped, witness, _ = sizes
+            witness += compact_size_len(len(item)) + len(item)
+            witness += compact_size_len(len(stack)) - compact_size_len(len(stack) - 1)
+            self._sizes = (stripped, witness, True)
+
+    def _get_sizes(self):
+        """The size without witness and the bytes the witness adds to it."""
+        if self._sizes is None or not self._sizes[2]:
+            stripped, witness = self._stripped_size(), self._witness_size()
+        else:
+            stripped, witness, _ = self._sizes
+        # from here on, only add_input() and the like keep them up to date
+        self._sizes = (stripped, witness, False)
+        return stripped, witness
+
+    def _stripped_size(self):
+        return (
+            8
+            + compact_size_len(len(self.vin))
+            + sum(txin.serialized_size() for txin in self.vin)
+            + compact_size_len(len(self.vout))
+            + sum(txout.serialized_size() for txout in self.vout)
+        )
+
+    def _witness_size(self):
+        if self.wit.is_null():
+            return 0
+        # serialize_into() pads or truncates vtxinwit to the length of vin
+        vtxinwit = self.wit.vtxinwit[: len(self.vin)]
+        return (
+            2
+            + len(self.vin)
+            - len(vtxinwit)
+            + sum(inwit.serialized_size() for inwit in vtxinwit)
+        )
+
     # Calculate the transaction weight using witness and non-witness
     # serialization size (does NOT use sigops).
     def get_weight(self):
-        with_witness_size = len(self.serialize_with_witness())
-        without_witness_size = len(self.serialize_without_witness())
-        return (WITNESS_SCALE_FACTOR - 1) * without_witness_size + with_witness_size
+        stripped, witness = self._get_sizes()
+        return WITNESS_SCALE_FACTOR * stripped + witness
 
     def get_vsize(self):
         return math.ceil(self.get_weight() / WITNESS_SCALE_FACTOR)
@@ -662,6 +1003,38 @@ class CTransaction:
         )
 
 
+class StandardTemplateHashContext:
+    """Precomputed BIP119 standard template hash state for a transaction.
+
+    The per-field hashes are computed once and the preimage up to (and
+    excluding) the outputs hash is kept as a SHA-256 midstate, so the hash
+    for every input index -- or for a transaction of the same shape with
+    different outputs -- costs a single compression."""
+    __slots__ = ("n_in", "outputs_hash", "prefix")
+
+    def __init__(self, tx):
+        prefix = hashlib.sha256(struct.pack("<iI", tx.nVersion, tx.nLockTime))
+        if any(inp.scriptSig for inp in tx.vin):
+            prefix.update(sha256(b"".join(ser_string(inp.scriptSig) for inp in tx.vin)))
+        prefix.update(struct.pack("<I", len(tx.vin)))
+        prefix.update(sha256(b"".join(struct.pack("<I", inp.nSequence) for inp in tx.vin)))
+        prefix.update(struct.pack("<I", len(tx.vout)))
+        self.prefix = prefix
+        self.outputs_hash = sha256(b"".join(out.serialize() for out in tx.vout))
+        self.n_in = len(tx.vin)
+
+    def get_hash(self, nIn, outputs_hash=None):
+        """Return the template hash for input nIn, optionally replacing the
+        outputs hash with the one of another transaction of the same shape."""
+        h = self.prefix.copy()
+        h.update(outputs_hash or self.outputs_hash)
+        h.update(struct.pack("<I", nIn))
+        return h.digest()
+
+    def get_hashes(self):
+        return [self.get_hash(nIn) for nIn in range(self.n_in)]
+
+
 class CBlockHeader:
     __slots__ = (
         "hash",
@@ -708,15 +1081,24 @@ class CBlockHeader:
         self.sha256 = None
         self.hash = None
 
+    def deserialize_cursor(self, c):
+        self.nVersion = c.unpack(_INT32)[0]
+        self.hashPrevBlock = c.uint256()
+        self.hashMerkleRoot = c.uint256()
+        self.nTime, self.nBits, self.nNonce = c.unpack(_HEADER_TAIL)
+        self.sha256 = None
+        self.hash = None
+
     def serialize(self):
-        r = b""
-        r += struct.pack("<i", self.nVersion)
+        r = bytearray()
+        CBlockHeader.serialize_into(self, r)
+        return bytes(r)
+
+    def serialize_into(self, r):
+        r += _INT32.pack(self.nVersion)
         r += ser_uint256(self.hashPrevBlock)
         r += ser_uint256(self.hashMerkleRoot)
-        r += struct.pack("<I", self.nTime)
-        r += struct.pack("<I", self.nBits)
-        r += struct.pack("<I", self.nNonce)
-        return r
+        r += _HEADER_TAIL.pack(self.nTime, self.nBits, self.nNonce)
 
     def calc_sha256(self):
         if self.sha256 is None:
@@ -749,6 +1131,7 @@ class CBlockHeader:
         )
 
 
+_HEADER_TAIL = struct.Struct("<III")
 BLOCK_HEADER_SIZE = len(CBlockHeader().serialize())
 assert_equal(BLOCK_HEADER_SIZE, 80)
 
@@ -761,17 +1144,24 @@ class CBlock(CBlockHeader):
         self.vtx = []
 
     def deserialize(self, f):
+        if isinstance(f, (BytesIO, ByteCursor)):
+            deserialize_with_cursor(self, f)
+            return
         super().deserialize(f)
         self.vtx = deser_vector(f, CTransaction)
 
+    def deserialize_cursor(self, c):
+        super().deserialize_cursor(c)
+        self.vtx = deser_vector_cursor(c, CTransaction)
+
     def serialize(self, with_witness=True):
-        r = b""
-        r += super().serialize()
-        if with_witness:
-            r += ser_vector(self.vtx, "serialize_with_witness")
-        else:
-            r += ser_vector(self.vtx, "serialize_without_witness")
-        return r
+        return serialize_with(self, with_witness)
+
+    def serialize_into(self, r, with_witness=True):
+        super().serialize_into(r)
+        r += ser_compact_size(len(self.vtx))
+        for tx in self.vtx:
+            tx.serialize_into(r, with_witness)
 
     # Calculate the merkle root given a vector of transaction hashes
     @classmethod
@@ -824,9 +1214,13 @@ class CBlock(CBlockHeader):
     # Calculate the block weight using witness and non-witness
     # serialization size (does NOT use sigops).
     def get_weight(self):
-        with_witness_size = len(self.serialize(with_witness=True))
-        without_witness_size = len(self.serialize(with_witness=False))
-        return (WITNESS_SCALE_FACTOR - 1) * without_witness_size + with_witness_size
+        stripped = 80 + compact_size_len(len(self.vtx))
+        witness = 0
+        for tx in self.vtx:
+            tx_stripped, tx_witness = tx._get_sizes()
+            stripped += tx_stripped
+            witness += tx_witness
+        return WITNESS_SCALE_FACTOR * stripped + witness
 
     def __repr__(self):
         return (
@@ -1376,6 +1770,9 @@ class msg_tx:
     def serialize(self):
         return self.tx.serialize_with_witness()
 
+    def serialize_into(self, r):
+        self.tx.serialize_into(r, True)
+
     def __repr__(self):
         return "msg_tx(tx=%s)" % (repr(self.tx))
 
@@ -1403,6 +1800,9 @@ class msg_no_witness_tx(msg_tx):
     def serialize(self):
         return self.tx.serialize_without_witness()
 
+    def serialize_into(self, r):
+        self.tx.serialize_into(r, False)
+
 
 class msg_block:
     __slots__ = ("block",)
@@ -1420,6 +1820,9 @@ class msg_block:
     def serialize(self):
         return self.block.serialize()
 
+    def serialize_into(self, r):
+        self.block.serialize_into(r, True)
+
     def __repr__(self):
         return "msg_block(block=%s)" % (repr(self.block))
 
@@ -1446,6 +1849,9 @@ class msg_no_witness_block(msg_block):
     def serialize(self):
         return self.block.serialize(with_witness=False)
 
+    def serialize_into(self, r):
+        self.block.serialize_into(r, False)
+
 
 class msg_getaddr:
     __slots__ = ()
@@ -1962,3 +2368,198 @@ class msg_cfcheckpt:
         return "msg_cfcheckpt(filter_type={:#x}, stop_hash={:x})".format(
             self.filter_type, self.stop_hash
         )
+
+
+class TestFrameworkMessages(unittest.TestCase):
+    def random_tx(self, rng):
+        tx = CTransaction()
+        tx.nVersion = rng.choice([1, 2, -1])
+        tx.nLockTime = rng.getrandbits(32)
+        # without inputs the serialization reads as a witness one
+        for _ in range(rng.randrange(1, 4)):
+            outpoint = COutPoint(rng.getrandbits(256), rng.getrandbits(32))
+            script_sig = bytes(rng.choice([0, 5, 252, 253, 300]))
+            tx.vin.append(CTxIn(outpoint, script_sig, rng.getrandbits(32)))
+        for _ in range(rng.randrange(4)):
+            value = rng.getrandbits(62) - 2**61
+            tx.vout.append(CTxOut(value, bytes(rng.choice([0, 22, 252, 253]))))
+        if rng.random() < 0.6:
+            tx.wit.vtxinwit = [CTxInWitness() for _ in tx.vin]
+            for inwit in tx.wit.vtxinwit:
+                inwit.scriptWitness.stack = [
+                    bytes(rng.randrange(300)) for _ in range(rng.randrange(3))
+                ]
+        return tx
+
+    def test_rehash_after_mutation(self):
+        tx = CTransaction()
+        tx.vin = [CTxIn(COutPoint(1, 0))]
+        tx.vout = [CTxOut(1000, b"\x51")]
+        txid = tx.rehash()
+        wtxid = tx.getwtxid()
+        weight = tx.get_weight()
+
+        tx.vout[0].nValue -= 1
+        tx.vin[0].nSequence = 1
+        self.assertNotEqual(tx.rehash(), txid)
+        self.assertEqual(tx.hash, hash256(tx.serialize())[::-1].hex())
+
+        tx.vout.append(CTxOut(0, b"\x6a"))
+        self.assertEqual(tx.serialize()[-14:-4], CTxOut(0, b"\x6a").serialize())
+        tx.sha256 = None
+        tx.calc_sha256()
+        self.assertEqual(tx.sha256, uint256_from_str(hash256(tx.serialize())))
+
+        tx.wit.vtxinwit = [CTxInWitness()]
+        tx.wit.vtxinwit[0].scriptWitness.stack = [b"\x01"]
+        tx.rehash()
+        self.assertNotEqual(tx.getwtxid(), wtxid)
+        self.assertEqual(tx.getwtxid(), hash256(tx.serialize())[::-1].hex())
+        # a 10 byte output, then marker, flag and a one item witness
+        self.assertEqual(tx.get_weight(), weight + 4 * 10 + 2 + 3)
+
+        # the getters follow direct mutations too
+        tx.wit.vtxinwit[0].scriptWitness.stack.append(b"\x02" * 5)
+        tx.vout.append(CTxOut(0, b"\x6a"))
+        self.assertEqual(tx.getwtxid(), hash256(tx.serialize())[::-1].hex())
+        self.assertEqual(tx.get_weight(), weight + 4 * 20 + 2 + 3 + 6)
+        tx.add_output(CTxOut(0, b"\x6a"))
+        self.assertEqual(tx.get_weight(), weight + 4 * 30 + 2 + 3 + 6)
+        tx.vout.pop()
+        self.assertEqual(tx.get_weight(), weight + 4 * 20 + 2 + 3 + 6)
+
+    def test_cursor_deserialize(self):
+        rng = random.Random(21)
+        for _ in range(200):
+            data = self.random_tx(rng).serialize()
+            tx = from_hex(CTransaction(), data.hex())
+            self.assertEqual(tx.serialize(), data)
+            # the stream path reads the same transaction
+            stream_tx = CTransaction()
+            stream_tx.deserialize(BufferedReader(BytesIO(data)))
+            self.assertEqual(repr(stream_tx), repr(tx))
+
+            # the cursor is left right after each object
+            c = ByteCursor(data + data)
+            for _ in range(2):
+                CTransaction().deserialize(c)
+            self.assertEqual(c.pos, 2 * len(data))
+
+            for n in rng.sample(range(len(data)), min(len(data), 20)):
+                with self.assertRaises((struct.error, IndexError)):
+                    CTransaction().deserialize(ByteCursor(data[:n]))
+
+        block = CBlock()
+        block.nTime = 3
+        block.vtx = [self.random_tx(rng) for _ in range(20)]
+        data = block.serialize()
+        self.assertEqual(from_hex(CBlock(), data.hex()).serialize(), data)
+        with self.assertRaises((struct.error, IndexError)):
+            from_hex(CBlock(), data[:-1].hex())
+
+    def test_serialize_into(self):
+        def reference(tx, with_witness):
+            r = struct.pack("<i", tx.nVersion)
+            with_witness = with_witness and not tx.wit.is_null()
+            if with_witness:
+                r += b"\x00\x01"
+            r += ser_compact_size(len(tx.vin))
+            for txin in tx.vin:
+                r += txin.prevout.hash.to_bytes(32, "little")
+                r += struct.pack("<I", txin.prevout.n)
+                r += ser_string(txin.scriptSig)
+                r += struct.pack("<I", txin.nSequence)
+            r += ser_compact_size(len(tx.vout))
+            for txout in tx.vout:
+                r += struct.pack("<q", txout.nValue) + ser_string(txout.scriptPubKey)
+            if with_witness:
+                for inwit in tx.wit.vtxinwit:
+                    r += ser_string_vector(inwit.scriptWitness.stack)
+            return r + struct.pack("<I", tx.nLockTime)
+
+        rng = random.Random(22)
+        block = CBlock()
+        block.hashPrevBlock = rng.getrandbits(256)
+        block.vtx = [self.random_tx(rng) for _ in range(50)]
+        for tx in block.vtx:
+            for with_witness in (True, False):
+                r = bytearray(b"prefix")
+                tx.serialize_into(r, with_witness)
+                self.assertEqual(bytes(r), b"prefix" + reference(tx, with_witness))
+            self.assertEqual(tx.serialize(), reference(tx, True))
+            self.assertEqual(tx.serialize_without_witness(), reference(tx, False))
+            self.assertEqual(msg_tx(tx).serialize(), reference(tx, True))
+            self.assertEqual(msg_no_witness_tx(tx).serialize(), reference(tx, False))
+
+        header = CBlockHeader.serialize(block)
+        self.assertEqual(len(header), 80)
+        for with_witness in (True, False):
+            self.assertEqual(
+                block.serialize(with_witness),
+                header
+                + ser_compact_size(len(block.vtx))
+                + b"".join(reference(tx, with_witness) for tx in block.vtx),
+            )
+        self.assertEqual(msg_block(block).serialize(), block.serialize())
+        self.assertEqual(
+            msg_no_witness_block(block).serialize(), block.serialize(False)
+        )
+
+    def test_weight(self):
+        def serialized_weight(tx):
+            # serializing pads or truncates vtxinwit, so measure a copy
+            tx = tx.copy()
+            stripped = len(tx.serialize_without_witness())
+            return 3 * stripped + len(tx.serialize_with_witness())
+
+        for n in (0, 252, 253, 0xFFFF, 0x10000, 0xFFFFFFFF, 0x100000000):
+            self.assertEqual(compact_size_len(n), len(ser_compact_size(n)))
+
+        rng = random.Random(24)
+        for _ in range(30):
+            tx = self.random_tx(rng)
+            self.assertEqual(tx.get_weight(), serialized_weight(tx))
+            # kept up to date incrementally, across compact size boundaries
+            for _ in range(rng.randrange(800)):
+                step = rng.random()
+                if step < 0.4:
+                    tx.add_output(CTxOut(1, bytes(rng.randrange(300))))
+                elif step < 0.7:
+                    tx.add_input(CTxIn(COutPoint(), bytes(rng.randrange(300))))
+                else:
+                    nIn = rng.randrange(len(tx.vin) + 2)
+                    tx.add_witness_item(nIn, bytes(rng.randrange(300)))
+                tx.get_weight()
+            self.assertEqual(tx.get_weight(), serialized_weight(tx))
+            self.assertEqual(tx.get_vsize(), math.ceil(serialized_weight(tx) / 4))
+
+        block = CBlock()
+        block.vtx = [self.random_tx(rng) for _ in range(20)]
+        self.assertEqual(
+            block.get_weight(),
+            3 * len(block.serialize(False)) + len(block.serialize(True)),
+        )
+
+    def test_copy(self):
+        rng = random.Random(25)
+        for _ in range(50):
+            tx = self.random_tx(rng)
+            tx.rehash()
+            data = tx.serialize()
+            for clone in (tx.copy(), CTransaction(tx)):
+                self.assertEqual(repr(clone), repr(tx))
+                self.assertEqual(clone.serialize(), data)
+                self.assertEqual(clone.hash, tx.hash)
+
+                # every mutable container is the copy's own
+                for txin in clone.vin:
+                    txin.prevout.n ^= 1
+                    txin.nSequence ^= 1
+                for txout in clone.vout:
+                    txout.nValue += 1
+                for inwit in clone.wit.vtxinwit:
+                    inwit.scriptWitness.stack.append(b"\x01")
+                clone.vin.append(CTxIn())
+                clone.vout.append(CTxOut())
+                clone.wit.vtxinwit.append(CTxInWitness())
+                self.assertEqual(tx.serialize(), data)
@@ -282,16 +282,22 @@ class P2PConnection(asyncio.Protocol):
     def build_message(self, message):
         """Build a serialized P2P message"""
         msgtype = message.msgtype
-        data = message.serialize()
-        tmsg = self.magic_bytes
+        tmsg = bytearray(self.magic_bytes)
         tmsg += msgtype
         tmsg += b"\x00" * (12 - len(msgtype))
-        tmsg += struct.pack("<I", len(data))
-        th = sha256(data)
-        h = sha256(th)
-        tmsg += h[:4]
-        tmsg += data
-        return tmsg
+        # length and checksum are filled in once the payload is written
+        header_size = len(tmsg) + 8
+        tmsg += bytes(8)
+        if hasattr(message, "serialize_into"):
+            message.serialize_into(tmsg)
+        else:
+            tmsg += message.serialize()
+        with memoryview(tmsg) as data:
+            payload = data[header_size:]
+            h = sha256(sha256(payload))
+            payload.release()
+        tmsg[header_size - 8 : header_size] = struct.pack("<I", len(tmsg) - header_size) + h[:4]
+        return bytes(tmsg)
 
     def _log_message(self, direction, msg):
         """Logs a message being sent or received over the connection."""
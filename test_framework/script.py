@@ -15,13 +15,12 @@ from typing import List, Dict
 from .key import TaggedHash, tweak_add_pubkey
 
 from .messages import (
-    CTransaction,
     CTxOut,
     hash256,
+    ser_compact_size,
     ser_string,
-    ser_uint256,
     sha256,
-    uint256_from_str,
+    tx_from_hex,
 )
 
 from .ripemd160 import ripemd160
@@ -620,52 +619,65 @@ def FindAndDelete(script, sig):
         r += script[last_sop_idx:]
     return CScript(r)
 
-def LegacySignatureMsg(script, txTo, inIdx, hashtype):
-    """Preimage of the signature hash, if it exists.
+class LegacySignatureContext:
+    """Serialized pieces of a transaction shared by the legacy signature
+    messages of all its inputs, so that each message is a single join instead
+    of a copy and reserialization of the transaction.
 
-    Returns either (None, err) to indicate error (which translates to sighash 1),
-    or (msg, None).
+    The transaction must not be modified while the context is in use.
     """
 
-    if inIdx >= len(txTo.vin):
-        return (None, "inIdx %d out of range (%d)" % (inIdx, len(txTo.vin)))
-    txtmp = CTransaction(txTo)
-
-    for txin in txtmp.vin:
-        txin.scriptSig = b''
-    txtmp.vin[inIdx].scriptSig = FindAndDelete(script, CScript([OP_CODESEPARATOR]))
-
-    if (hashtype & 0x1f) == SIGHASH_NONE:
-        txtmp.vout = []
-
-        for i in range(len(txtmp.vin)):
-            if i != inIdx:
-                txtmp.vin[i].nSequence = 0
-
-    elif (hashtype & 0x1f) == SIGHASH_SINGLE:
-        outIdx = inIdx
-        if outIdx >= len(txtmp.vout):
-            return (None, "outIdx %d out of range (%d)" % (outIdx, len(txtmp.vout)))
-
-        tmp = txtmp.vout[outIdx]
-        txtmp.vout = []
-        for _ in range(outIdx):
-            txtmp.vout.append(CTxOut(-1))
-        txtmp.vout.append(tmp)
-
-        for i in range(len(txtmp.vin)):
-            if i != inIdx:
-                txtmp.vin[i].nSequence = 0
+    NULL_OUTPUT = CTxOut(-1).serialize()
+    NULL_SEQUENCE = struct.pack("<I", 0)
+
+    def __init__(self, txTo):
+        self.txTo = txTo
+        self.version = struct.pack("<i", txTo.nVersion)
+        self.prevouts = [i.prevout.serialize() for i in txTo.vin]
+        self.sequences = [struct.pack("<I", i.nSequence) for i in txTo.vin]
+        self.outputs = [o.serialize() for o in txTo.vout]
+        self.all_outputs = ser_compact_size(len(self.outputs)) + b"".join(self.outputs)
+        self.locktime = struct.pack("<I", txTo.nLockTime)
+
+    def msg(self, script, inIdx, hashtype):
+        """Same as LegacySignatureMsg(script, txTo, inIdx, hashtype)."""
+        if inIdx >= len(self.prevouts):
+            return (None, "inIdx %d out of range (%d)" % (inIdx, len(self.prevouts)))
+        base_type = hashtype & 0x1f
+        if base_type == SIGHASH_SINGLE and inIdx >= len(self.outputs):
+            return (None, "outIdx %d out of range (%d)" % (inIdx, len(self.outputs)))
+
+        script_code = ser_string(FindAndDelete(script, CScript([OP_CODESEPARATOR])))
+        # other inputs commit to their sequence only when all outputs are signed
+        other_sequences = base_type not in (SIGHASH_NONE, SIGHASH_SINGLE)
+        if hashtype & SIGHASH_ANYONECANPAY:
+            inputs = [inIdx]
+        else:
+            inputs = range(len(self.prevouts))
 
-    if hashtype & SIGHASH_ANYONECANPAY:
-        tmp = txtmp.vin[inIdx]
-        txtmp.vin = []
-        txtmp.vin.append(tmp)
+        parts = [self.version, ser_compact_size(len(inputs))]
+        for i in inputs:
+            parts.append(self.prevouts[i])
+            if i == inIdx:
+                parts += [script_code, self.sequences[i]]
+            else:
+                parts += [b"\x00", self.sequences[i] if other_sequences else self.NULL_SEQUENCE]
+        if base_type == SIGHASH_NONE:
+            parts.append(ser_compact_size(0))
+        elif base_type == SIGHASH_SINGLE:
+            parts += [ser_compact_size(inIdx + 1), self.NULL_OUTPUT * inIdx, self.outputs[inIdx]]
+        else:
+            parts.append(self.all_outputs)
+        parts += [self.locktime, struct.pack(b"<I", hashtype)]
+        return (b"".join(parts), None)
 
-    s = txtmp.serialize_without_witness()
-    s += struct.pack(b"<I", hashtype)
+def LegacySignatureMsg(script, txTo, inIdx, hashtype):
+    """Preimage of the signature hash, if it exists.
 
-    return (s, None)
+    Returns either (None, err) to indicate error (which translates to sighash 1),
+    or (msg, None).
+    """
+    return LegacySignatureContext(txTo).msg(script, inIdx, hashtype)
 
 def LegacySignatureHash(*args, **kwargs):
     """Consensus-correct SignatureHash
@@ -681,49 +693,61 @@ def LegacySignatureHash(*args, **kwargs):
     else:
         return (hash256(msg), err)
 
-# TODO: Allow cached hashPrevouts/hashSequence/hashOutputs to be provided.
-# Performance optimization probably not necessary for python tests, however.
+class SegwitV0SignatureContext:
+    """BIP143 hashPrevouts, hashSequence and hashOutputs of a transaction,
+    computed once and shared by the signature messages of all its inputs,
+    whatever their hashtype and amount.
+
+    The transaction must not be modified while the context is in use.
+    """
+
+    ZERO_HASH = bytes(32)
+
+    def __init__(self, txTo):
+        self.txTo = txTo
+        self.hashPrevouts = hash256(b"".join(i.prevout.serialize() for i in txTo.vin))
+        self.hashSequence = hash256(b"".join(struct.pack("<I", i.nSequence) for i in txTo.vin))
+        self.hashOutputs = hash256(b"".join(o.serialize() for o in txTo.vout))
+        self.version = struct.pack("<i", txTo.nVersion)
+        self.locktime = struct.pack("<I", txTo.nLockTime)
+
+    def msg(self, script, inIdx, hashtype, amount):
+        """Same as SegwitV0SignatureMsg(script, txTo, inIdx, hashtype, amount)."""
+        txin = self.txTo.vin[inIdx]
+        base_type = hashtype & 0x1f
+        anyonecanpay = hashtype & SIGHASH_ANYONECANPAY
+        all_outputs = base_type != SIGHASH_SINGLE and base_type != SIGHASH_NONE
+
+        hashPrevouts = self.ZERO_HASH if anyonecanpay else self.hashPrevouts
+        hashSequence = self.hashSequence if not anyonecanpay and all_outputs else self.ZERO_HASH
+        if all_outputs:
+            hashOutputs = self.hashOutputs
+        elif base_type == SIGHASH_SINGLE and inIdx < len(self.txTo.vout):
+            hashOutputs = hash256(self.txTo.vout[inIdx].serialize())
+        else:
+            hashOutputs = self.ZERO_HASH
+
+        return b"".join([
+            self.version,
+            hashPrevouts,
+            hashSequence,
+            txin.prevout.serialize(),
+            ser_string(script),
+            struct.pack("<q", amount),
+            struct.pack("<I", txin.nSequence),
+            hashOutputs,
+            self.locktime,
+            struct.pack("<I", hashtype),
+        ])
+
+    def hash(self, script, inIdx, hashtype, amount):
+        return hash256(self.msg(script, inIdx, hashtype, amount))
+
 # Note that this corresponds to sigversion == 1 in EvalScript, which is used
-# for version 0 witnesses.
+# for version 0 witnesses. Use a SegwitV0SignatureContext to sign several
+# inputs of the same transaction.
 def SegwitV0SignatureMsg(script, txTo, inIdx, hashtype, amount):
-
-    hashPrevouts = 0
-    hashSequence = 0
-    hashOutputs = 0
-
-    if not (hashtype & SIGHASH_ANYONECANPAY):
-        serialize_prevouts = bytes()
-        for i in txTo.vin:
-            serialize_prevouts += i.prevout.serialize()
-        hashPrevouts = uint256_from_str(hash256(serialize_prevouts))
-
-    if (not (hashtype & SIGHASH_ANYONECANPAY) and (hashtype & 0x1f) != SIGHASH_SINGLE and (hashtype & 0x1f) != SIGHASH_NONE):
-        serialize_sequence = bytes()
-        for i in txTo.vin:
-            serialize_sequence += struct.pack("<I", i.nSequence)
-        hashSequence = uint256_from_str(hash256(serialize_sequence))
-
-    if ((hashtype & 0x1f) != SIGHASH_SINGLE and (hashtype & 0x1f) != SIGHASH_NONE):
-        serialize_outputs = bytes()
-        for o in txTo.vout:
-            serialize_outputs += o.serialize()
-        hashOutputs = uint256_from_str(hash256(serialize_outputs))
-    elif ((hashtype & 0x1f) == SIGHASH_SINGLE and inIdx < len(txTo.vout)):
-        serialize_outputs = txTo.vout[inIdx].serialize()
-        hashOutputs = uint256_from_str(hash256(serialize_outputs))
-
-    ss = bytes()
-    ss += struct.pack("<i", txTo.nVersion)
-    ss += ser_uint256(hashPrevouts)
-    ss += ser_uint256(hashSequence)
-    ss += txTo.vin[inIdx].prevout.serialize()
-    ss += ser_string(script)
-    ss += struct.pack("<q", amount)
-    ss += struct.pack("<I", txTo.vin[inIdx].nSequence)
-    ss += ser_uint256(hashOutputs)
-    ss += struct.pack("<i", txTo.nLockTime)
-    ss += struct.pack("<I", hashtype)
-    return ss
+    return SegwitV0SignatureContext(txTo).msg(script, inIdx, hashtype, amount)
 
 def SegwitV0SignatureHash(*args, **kwargs):
     return hash256(SegwitV0SignatureMsg(*args, **kwargs))
@@ -750,6 +774,24 @@ class TestFrameworkScript(unittest.TestCase):
         self.assertEqual(bn2vch(123456789), bytes([0x15, 0xCD, 0x5B, 0x07]))
         self.assertEqual(bn2vch(-54321), bytes([0x31, 0xD4, 0x80]))
 
+    def test_segwitv0_signature_hash(self):
+        # native P2WPKH example from BIP143
+        tx = tx_from_hex("0100000002fff7f7881a8099afa6940d42d1e7f6362bec38171ea3edf433541db4e4ad969f0000000000eeffffffef51e1b804cc89d182d279655c3aa89e815b1b309fe287d9b2b55d57b90ec68a0100000000ffffffff02202cb206000000001976a9148280b37df378db99f66f85c95a783a76ac7a6d5988ac9093510d000000001976a9143bde42dbee7e4dbe6a21b2d50ce2f0167faa815988ac11000000")
+        script_code = CScript(bytes.fromhex("76a9141d0f172a0ecb48aee1be1f2687d2963ae33f71a188ac"))
+        expected = "c37af31116d1b27caf68aae9e3ac82f1477929014d5b917657d0eb49478cb670"
+        self.assertEqual(SegwitV0SignatureHash(script_code, tx, 1, SIGHASH_ALL, 600000000).hex(), expected)
+        self.assertEqual(SegwitV0SignatureContext(tx).hash(script_code, 1, SIGHASH_ALL, 600000000).hex(), expected)
+
+    def test_taproot_signature_context(self):
+        # one context serves every input, hash type and spend path
+        tx = tx_from_hex("0100000002fff7f7881a8099afa6940d42d1e7f6362bec38171ea3edf433541db4e4ad969f0000000000eeffffffef51e1b804cc89d182d279655c3aa89e815b1b309fe287d9b2b55d57b90ec68a0100000000ffffffff02202cb206000000001976a9148280b37df378db99f66f85c95a783a76ac7a6d5988ac9093510d000000001976a9143bde42dbee7e4dbe6a21b2d50ce2f0167faa815988ac11000000")
+        spent_utxos = [CTxOut(625000000, CScript([OP_1, bytes(32)])), CTxOut(600000000, CScript([OP_1, bytes(range(32))]))]
+        ctx = TaprootSignatureContext(tx, spent_utxos)
+        for hash_type in [0, 1, 2, 3, 0x81, 0x82, 0x83]:
+            for input_index in range(len(tx.vin)):
+                for kwargs in [{}, {"annex": bytes([0x50, 1, 2])}, {"scriptpath": True, "script": CScript([OP_TRUE]), "codeseparator_pos": 3}]:
+                    self.assertEqual(ctx.hash(hash_type, input_index, **kwargs), TaprootSignatureHash(tx, spent_utxos, hash_type, input_index, **kwargs))
+
     def test_cscriptnum_encoding(self):
         # round-trip negative and multi-byte CScriptNums
         values = [0, 1, -1, -2, 127, 128, -255, 256, (1 << 15) - 1, -(1 << 16), (1 << 24) - 1, (1 << 31), 1 - (1 << 32), 1 << 40, 1500, -1500]
@@ -771,48 +813,75 @@ def BIP341_sha_sequences(txTo):
 def BIP341_sha_outputs(txTo):
     return sha256(b"".join(o.serialize() for o in txTo.vout))
 
-def TaprootSignatureMsg(txTo, spent_utxos, hash_type, input_index = 0, scriptpath = False, script = CScript(), codeseparator_pos = -1, annex = None, leaf_ver = LEAF_VERSION_TAPSCRIPT):
-    assert (len(txTo.vin) == len(spent_utxos))
-    assert (input_index < len(txTo.vin))
-    out_type = SIGHASH_ALL if hash_type == 0 else hash_type & 3
-    in_type = hash_type & SIGHASH_ANYONECANPAY
-    spk = spent_utxos[input_index].scriptPubKey
-    ss = bytes([0, hash_type]) # epoch, hash_type
-    ss += struct.pack("<i", txTo.nVersion)
-    ss += struct.pack("<I", txTo.nLockTime)
-    if in_type != SIGHASH_ANYONECANPAY:
-        ss += BIP341_sha_prevouts(txTo)
-        ss += BIP341_sha_amounts(spent_utxos)
-        ss += BIP341_sha_scriptpubkeys(spent_utxos)
-        ss += BIP341_sha_sequences(txTo)
-    if out_type == SIGHASH_ALL:
-        ss += BIP341_sha_outputs(txTo)
-    spend_type = 0
-    if annex is not None:
-        spend_type |= 1
-    if (scriptpath):
-        spend_type |= 2
-    ss += bytes([spend_type])
-    if in_type == SIGHASH_ANYONECANPAY:
-        ss += txTo.vin[input_index].prevout.serialize()
-        ss += struct.pack("<q", spent_utxos[input_index].nValue)
-        ss += ser_string(spk)
-        ss += struct.pack("<I", txTo.vin[input_index].nSequence)
-    else:
-        ss += struct.pack("<I", input_index)
-    if (spend_type & 1):
-        ss += sha256(ser_string(annex))
-    if out_type == SIGHASH_SINGLE:
-        if input_index < len(txTo.vout):
-            ss += sha256(txTo.vout[input_index].serialize())
+class TaprootSignatureContext:
+    """BIP341 signature message state of a transaction spending `spent_utxos`.
+
+    The shared sha_prevouts, sha_amounts, sha_scriptpubkeys, sha_sequences
+    and sha_outputs digests are computed once, so key path and script path
+    messages for every input and hash type cost the same regardless of the
+    transaction size. The transaction must not be modified while the context
+    is in use.
+    """
+
+    def __init__(self, txTo, spent_utxos):
+        assert (len(txTo.vin) == len(spent_utxos))
+        self.txTo = txTo
+        self.spent_utxos = spent_utxos
+        self.header = struct.pack("<iI", txTo.nVersion, txTo.nLockTime)
+        self.sha_inputs = b"".join([
+            BIP341_sha_prevouts(txTo),
+            BIP341_sha_amounts(spent_utxos),
+            BIP341_sha_scriptpubkeys(spent_utxos),
+            BIP341_sha_sequences(txTo),
+        ])
+        self.sha_outputs = BIP341_sha_outputs(txTo)
+
+    def msg(self, hash_type, input_index = 0, scriptpath = False, script = CScript(), codeseparator_pos = -1, annex = None, leaf_ver = LEAF_VERSION_TAPSCRIPT):
+        """Same as TaprootSignatureMsg(txTo, spent_utxos, ...)."""
+        txTo = self.txTo
+        assert (input_index < len(txTo.vin))
+        out_type = SIGHASH_ALL if hash_type == 0 else hash_type & 3
+        in_type = hash_type & SIGHASH_ANYONECANPAY
+        spend_type = 0
+        if annex is not None:
+            spend_type |= 1
+        if (scriptpath):
+            spend_type |= 2
+
+        ss = [bytes([0, hash_type]), self.header] # epoch, hash_type
+        if in_type != SIGHASH_ANYONECANPAY:
+            ss.append(self.sha_inputs)
+        if out_type == SIGHASH_ALL:
+            ss.append(self.sha_outputs)
+        ss.append(bytes([spend_type]))
+        if in_type == SIGHASH_ANYONECANPAY:
+            utxo = self.spent_utxos[input_index]
+            ss.append(txTo.vin[input_index].prevout.serialize())
+            ss.append(struct.pack("<q", utxo.nValue))
+            ss.append(ser_string(utxo.scriptPubKey))
+            ss.append(struct.pack("<I", txTo.vin[input_index].nSequence))
         else:
-            ss += bytes(0 for _ in range(32))
-    if (scriptpath):
-        ss += TaggedHash("TapLeaf", bytes([leaf_ver]) + ser_string(script))
-        ss += bytes([0])
-        ss += struct.pack("<i", codeseparator_pos)
-    assert len(ss) ==  175 - (in_type == SIGHASH_ANYONECANPAY) * 49 - (out_type != SIGHASH_ALL and out_type != SIGHASH_SINGLE) * 32 + (annex is not None) * 32 + scriptpath * 37
-    return ss
+            ss.append(struct.pack("<I", input_index))
+        if (spend_type & 1):
+            ss.append(sha256(ser_string(annex)))
+        if out_type == SIGHASH_SINGLE:
+            if input_index < len(txTo.vout):
+                ss.append(sha256(txTo.vout[input_index].serialize()))
+            else:
+                ss.append(bytes(32))
+        if (scriptpath):
+            ss.append(TaggedHash("TapLeaf", bytes([leaf_ver]) + ser_string(script)))
+            ss.append(bytes([0]))
+            ss.append(struct.pack("<i", codeseparator_pos))
+        ss = b"".join(ss)
+        assert len(ss) ==  175 - (in_type == SIGHASH_ANYONECANPAY) * 49 - (out_type != SIGHASH_ALL and out_type != SIGHASH_SINGLE) * 32 + (annex is not None) * 32 + scriptpath * 37
+        return ss
+
+    def hash(self, *args, **kwargs):
+        return TaggedHash("TapSighash", self.msg(*args, **kwargs))
+
+def TaprootSignatureMsg(txTo, spent_utxos, hash_type, *args, **kwargs):
+    return TaprootSignatureContext(txTo, spent_utxos).msg(hash_type, *args, **kwargs)
 
 def TaprootSignatureHash(*args, **kwargs):
     return TaggedHash("TapSighash", TaprootSignatureMsg(*args, **kwargs))
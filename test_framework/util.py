@@ -599,21 +599,26 @@ def find_vout_for_address(node, txid, addr):
     raise RuntimeError("Vout not found for address: txid=%s, addr=%s" % (txid, addr))
 
 def modinv(a, n):
-    """Compute the modular inverse of a modulo n using the extended Euclidean
-    Algorithm. See https://en.wikipedia.org/wiki/Extended_Euclidean_algorithm#Modular_integers.
-    """
-    # TODO: Change to pow(a, -1, n) available in Python 3.8
-    t1, t2 = 0, 1
-    r1, r2 = n, a
-    while r2 != 0:
-        q = r1 // r2
-        t1, t2 = t2, t1 - q * t2
-        r1, r2 = r2, r1 - q * r2
-    if r1 > 1:
+    """Compute the modular inverse of a modulo n, or None if there is none."""
+    try:
+        return pow(a, -1, n)
+    except ValueError:
         return None
-    if t1 < 0:
-        t1 += n
-    return t1
+
+def modinv_batch(values, n):
+    """Compute the modular inverses of all values modulo n with a single
+    inversion (Montgomery's trick). The values must all be invertible."""
+    prefix = []
+    acc = 1
+    for v in values:
+        prefix.append(acc)
+        acc = acc * v % n
+    inv = pow(acc, -1, n)
+    result = [0] * len(prefix)
+    for i in range(len(prefix) - 1, -1, -1):
+        result[i] = inv * prefix[i] % n
+        inv = inv * values[i] % n
+    return result
 
 class TestFrameworkUtil(unittest.TestCase):
     def test_modinv(self):
@@ -627,3 +632,5 @@ class TestFrameworkUtil(unittest.TestCase):
 
         for a, n in test_vectors:
             self.assertEqual(modinv(a, n), pow(a, n-2, n))
+        self.assertEqual(modinv_batch([a for a, _ in test_vectors[:3]], 4001), [modinv(a, 4001) for a, _ in test_vectors[:3]])
+        self.assertEqual(modinv(6, 9), None)
@@ -4,7 +4,6 @@
 # file COPYING or http://www.opensource.org/licenses/mit-license.php.
 """A limited-functionality wallet, which may replace a real wallet in tests"""
 
-from copy import deepcopy
 from decimal import Decimal
 from enum import Enum
 from random import choice
@@ -312,13 +311,13 @@ def bulk_transaction(tx, node, target_weight, privkeys, prevtxs=None):
     """Pad a transaction with extra outputs until it reaches a target weight (or higher).
     returns CTransaction object
     """
-    tx_heavy = deepcopy(tx)
+    tx_heavy = tx.copy()
     assert_greater_than_or_equal(target_weight, tx_heavy.get_weight())
     while tx_heavy.get_weight() < target_weight:
         random_spk = "6a4d0200"  # OP_RETURN OP_PUSH2 512 bytes
         for _ in range(512*2):
             random_spk += choice("0123456789ABCDEF")
-        tx_heavy.vout.append(CTxOut(0, bytes.fromhex(random_spk)))
+        tx_heavy.add_output(CTxOut(0, bytes.fromhex(random_spk)))
     # Re-sign the transaction
     if privkeys:
         signed = node.signrawtransactionwithkey(tx_heavy.serialize().hex(), privkeys, prevtxs)
@@ -326,4 +325,5 @@ def bulk_transaction(tx, node, target_weight, privkeys, prevtxs=None):
     # OP_TRUE
     tx_heavy.wit.vtxinwit = [CTxInWitness()]
     tx_heavy.wit.vtxinwit[0].scriptWitness.stack = [CScript([OP_TRUE])]
+    tx_heavy.invalidate()
     return tx_heavy
@@ -1,25 +1,41 @@
 import io
 import json
+import bisect
+import random
 import struct
 import shelve
 import hashlib
-from typing import List, Optional
-from dataclasses import dataclass
+import unittest
+from decimal import Decimal
+from typing import Dict, Iterator, List, Optional, Tuple
+from dataclasses import dataclass, field
 from contextlib import contextmanager
 from test_framework import script
 from test_framework.messages import (
     COIN,
+    CBlock,
+    CTxIn,
+    CTxOut,
     COutPoint,
     CTxWitness,
     CTransaction,
     CTxInWitness,
     CScriptWitness,
+    from_hex,
+    tx_from_hex,
 )
-from test_framework.script import CScript, OPCODE_NAMES
+from test_framework.script import CScript, CScriptInvalidError, OPCODE_NAMES
+from test_framework.segwit_addr import decode_segwit_address, encode_segwit_address
 from buidl.hd import HDPrivateKey, PrivateKey
-from rpc import BitcoinRPC, JSONRPCError
+from rpc import BitcoinRPC, CachingBitcoinRPC, JSONRPCError, RPCBatch
 
-rpc = BitcoinRPC(net_name="signet")
+rpc = CachingBitcoinRPC(BitcoinRPC(net_name="signet"))
+
+# how many of the last connected blocks can be undone after a reorg, a deeper
+# one makes the wallet rescan the utxo set
+UNDO_DEPTH = 144
+# how many raw blocks to fetch per batch while catching up
+BLOCK_BATCH = 16
 
 
 def log(*args, **kwargs):
@@ -40,62 +56,308 @@ class SpacechainTx:
     tmpl_bytes: Optional[bytes]
     id: Optional[str] = None
 
+    # decoded template and CTV hashes per input index, kept after first use
+    # and dropped whenever tmpl_bytes changes (never pickled into the store)
+    _template: Optional[CTransaction] = field(
+        default=None, init=False, repr=False, compare=False
+    )
+    _ctv_hashes: Dict[int, bytes] = field(
+        default_factory=dict, init=False, repr=False, compare=False
+    )
+
+    def __setattr__(self, name, value):
+        if name == "tmpl_bytes":
+            super().__setattr__("_template", None)
+            super().__setattr__("_ctv_hashes", {})
+        super().__setattr__(name, value)
+
+    def __getstate__(self):
+        return {"tmpl_bytes": self.tmpl_bytes, "id": self.id}
+
+    def __setstate__(self, state):
+        self.tmpl_bytes = state["tmpl_bytes"]
+        self.id = state.get("id")
+
     @property
     def template(self):
-        if self.tmpl_bytes:
+        """
+        The decoded template transaction. This is shared between calls, so
+        copy it with .copy() before modifying it.
+        """
+        if self._template is None and self.tmpl_bytes:
             tx = CTransaction()
             tx.deserialize(io.BytesIO(self.tmpl_bytes))
             tx.rehash()
-            return tx
+            self._template = tx
+        return self._template
 
     def ctv_hash(self, input_index=0):
-        return self.template.get_standard_template_hash(input_index)
+        if input_index not in self._ctv_hashes:
+            hashes = self.template.get_standard_template_hashes()
+            self._ctv_hashes = dict(enumerate(hashes))
+        return self._ctv_hashes[input_index]
 
 
 @dataclass
-class Wallet:
-    privkey: PrivateKey
-    coins: List["Coin"]
+class MempoolTracker:
+    """
+    Keeps the decoded mempool between scans: each update only fetches the
+    transactions that entered it since the last one and forgets the ones that
+    left, while keeping a map from every outpoint to the mempool transaction
+    spending it.
+    """
 
-    @classmethod
-    def generate(cls, seed: bytes) -> "Wallet":
-        return cls(
-            HDPrivateKey.from_seed(seed, network="signet").get_private_key(1),
-            [],
-        )
+    txs: Dict[str, CTransaction] = field(default_factory=dict)
+    spenders: Dict[Tuple[int, int], str] = field(default_factory=dict)
+
+    def update(self) -> Tuple[List[CTransaction], List[CTransaction]]:
+        """Syncs with the node, returns the (added, removed) transactions."""
+        current = set(rpc.getrawmempool())
+
+        removed = [self.txs.pop(txid) for txid in set(self.txs) - current]
+        for tx in removed:
+            for outpoint in _spent_outpoints(tx):
+                if self.spenders.get(outpoint) == tx.hash:
+                    del self.spenders[outpoint]
+
+        # transactions that left the mempool in the meantime are just skipped
+        added = list(fetch_txs(current - set(self.txs)).values())
+        for tx in added:
+            self.txs[tx.hash] = tx
+            for outpoint in _spent_outpoints(tx):
+                self.spenders[outpoint] = tx.hash
+
+        return added, removed
+
+    def spender(self, outpoint: COutPoint) -> Optional[str]:
+        return self.spenders.get((outpoint.hash, outpoint.n))
 
-    def scan(self):
-        self.coins = []
 
+def decode_tx(raw_hex: str, txid: Optional[str] = None) -> CTransaction:
+    """
+    Decodes a raw transaction as returned by the node. Its txid is hashed
+    unless given, as it is when the transaction was asked for by txid.
+    """
+    tx = tx_from_hex(raw_hex)
+    if txid is None:
+        tx.rehash()
+    else:
+        tx.sha256 = int(txid, 16)
+        tx.hash = txid
+    return tx
+
+
+def fetch_txs(txids) -> Dict[str, CTransaction]:
+    """
+    Fetches transactions in one batch as raw hex and decodes them here, which
+    is cheaper on both ends than verbose JSON. Transactions the node doesn't
+    know about are left out.
+    """
+    txids = list(txids)
+    batch = rpc.batch()
+    for txid in txids:
+        batch.getrawtransaction(txid)
+    return {
+        txid: decode_tx(raw, txid)
+        for txid, raw in zip(txids, batch.execute())
+        if not isinstance(raw, JSONRPCError)
+    }
+
+
+def fetch_blocks(start: int, stop: int) -> Iterator[CBlock]:
+    """
+    Yields the blocks of the active chain from height `start` up to `stop`
+    (excluded), fetched as raw hex in batches. Stops early if the chain gets
+    shorter meanwhile.
+    """
+    for first in range(start, stop, BLOCK_BATCH):
+        batch = rpc.batch()
+        for height in range(first, min(first + BLOCK_BATCH, stop)):
+            batch.getblockhash(height)
+        hashes = batch.execute()
+        known = [h for h in hashes if not isinstance(h, JSONRPCError)]
+
+        batch = rpc.batch()
+        for block_hash in known:
+            batch.getblock(block_hash, 0)
+        for raw in batch.execute():
+            if isinstance(raw, JSONRPCError):
+                return
+            yield from_hex(CBlock(), raw)
+        if len(known) < len(hashes):
+            return
+
+
+def address_script(address: str) -> bytes:
+    """The scriptPubKey of a signet segwit address."""
+    version, program = decode_segwit_address("tb", address)
+    if version is None:
+        raise ValueError(f"not a signet segwit address: {address}")
+    return bytes(CScript([version, bytes(program)]))
+
+
+def pays_to(txout: CTxOut, script_pubkey: bytes) -> bool:
+    return txout.scriptPubKey == script_pubkey
+
+
+def op_return_payload(script_pubkey: bytes) -> Optional[bytes]:
+    """The data pushed by an OP_RETURN output script, None for other scripts."""
+    if not script_pubkey or script_pubkey[0] != script.OP_RETURN:
+        return None
+    try:
+        pushes = list(CScript(script_pubkey[1:]))
+    except CScriptInvalidError:
+        return None
+    return b"".join(push for push in pushes if isinstance(push, bytes))
+
+
+def _spent_outpoints(tx: CTransaction) -> List[Tuple[int, int]]:
+    # coinbase inputs spend the null outpoint
+    return [(inp.prevout.hash, inp.prevout.n) for inp in tx.vin if inp.prevout.hash]
+
+
+def _received_coins(tx: CTransaction, script_pubkey: bytes) -> List["Coin"]:
+    outputs = [n for n, out in enumerate(tx.vout) if pays_to(out, script_pubkey)]
+    if outputs and tx.sha256 is None:
+        tx.rehash()
+    return [Coin(COutPoint(tx.sha256, n), tx.vout[n].nValue) for n in outputs]
+
+
+@dataclass
+class UtxoTracker:
+    """
+    The confirmed coins of one address as of block `tip`. The first sync
+    takes them from scantxoutset, later ones only connect the blocks mined
+    since, undoing the ones that got reorged out of the active chain first.
+    """
+
+    address: str
+    coins: "CoinSet" = field(default_factory=lambda: CoinSet())
+    tip: Optional[str] = None
+    height: int = -1
+    # (previous block hash, coins added, coins spent) of the last blocks
+    undo: List[Tuple[str, List["Coin"], List["Coin"]]] = field(default_factory=list)
+
+    def sync(self):
+        if self.tip is not None:
+            self._rewind()
+        if self.tip is None:
+            self._rescan()
+        while not self._connect():
+            # the chain was reorged while we were fetching blocks
+            self._rewind()
+            if self.tip is None:
+                self._rescan()
+
+    def _rescan(self):
         res = rpc.scantxoutset("start", [f"addr({self.address})"])
-        for utxo in res["unspents"]:
-            self.coins.append(
-                Coin(
-                    COutPoint(int(utxo["txid"], 16), utxo["vout"]),
-                    int(utxo["amount"] * COIN),
-                )
+        self.coins = CoinSet(
+            Coin(
+                COutPoint(int(utxo["txid"], 16), utxo["vout"]),
+                int(utxo["amount"] * COIN),
             )
+            for utxo in res["unspents"]
+        )
+        self.tip = res["bestblock"]
+        self.height = res["height"]
+        self.undo = []
+
+    def _rewind(self):
+        """Undoes the blocks no longer in the active chain."""
+        count = rpc.getblockcount()
+        while self.height > count or rpc.getblockhash(self.height) != self.tip:
+            if not self.undo:
+                # deeper than we can undo
+                self.tip = None
+                return
+            previous, added, spent = self.undo.pop()
+            # restore first, so coins created and spent in the block go away
+            for coin in spent:
+                self.coins.add(coin)
+            for coin in added:
+                self.coins.spend(coin.outpoint)
+            self.tip = previous
+            self.height -= 1
+
+    def _connect(self) -> bool:
+        """Connects blocks up to the node's tip, False if one didn't fit."""
+        script_pubkey = address_script(self.address)
+        count = rpc.getblockcount()
+        for start in range(self.height + 1, count + 1, BLOCK_BATCH):
+            batch = rpc.batch()
+            for height in range(start, min(start + BLOCK_BATCH, count + 1)):
+                batch.getblockhash(height)
+            hashes = batch.execute()
+            if any(isinstance(block_hash, JSONRPCError) for block_hash in hashes):
+                return False
+
+            batch = rpc.batch()
+            for block_hash in hashes:
+                batch.getblock(block_hash, 0)
+            for block_hash, raw in zip(hashes, batch.execute()):
+                if isinstance(raw, JSONRPCError):
+                    return False
+                block = from_hex(CBlock(), raw)
+                if "%064x" % block.hashPrevBlock != self.tip:
+                    return False
+                self._apply(block_hash, block, script_pubkey)
+        return True
+
+    def _apply(self, block_hash: str, block: CBlock, script_pubkey: bytes):
+        added, spent = [], []
+        for tx in block.vtx:
+            for outpoint in _spent_outpoints(tx):
+                coin = self.coins.spend(COutPoint(*outpoint))
+                if coin:
+                    spent.append(coin)
+            for coin in _received_coins(tx, script_pubkey):
+                self.coins.add(coin)
+                added.append(coin)
+
+        self.undo.append((self.tip, added, spent))
+        del self.undo[:-UNDO_DEPTH]
+        self.tip = block_hash
+        self.height += 1
+
+
+@dataclass
+class Wallet:
+    privkey: PrivateKey
+    coins: "CoinSet"
+    utxos: UtxoTracker
+    mempool: MempoolTracker = field(default_factory=MempoolTracker)
+    # coins received by transactions still in the mempool, by txid
+    mempool_coins: Dict[str, List["Coin"]] = field(default_factory=dict)
+
+    @classmethod
+    def generate(cls, seed: bytes, utxos: Optional[UtxoTracker] = None) -> "Wallet":
+        privkey = HDPrivateKey.from_seed(seed, network="signet").get_private_key(1)
+        address = privkey.point.p2wpkh_address(network="signet")
+        if utxos is None or utxos.address != address:
+            utxos = UtxoTracker(address)
+        return cls(privkey, CoinSet(), utxos)
 
-        for txid in rpc.getrawmempool():
-            raw = rpc.getrawtransaction(txid, 2)
-            for out in raw["vout"]:
-                if out["scriptPubKey"].get("address") == self.address:
-                    self.coins.append(
-                        Coin(
-                            COutPoint(int(raw["txid"], 16), out["n"]),
-                            int(out["value"] * COIN),
-                        )
-                    )
-
-        for txid in rpc.getrawmempool():
-            raw = rpc.getrawtransaction(txid, 2)
-            for inp in raw["vin"]:
-                for coin in self.coins:
-                    if (
-                        int(inp["txid"], 16) == coin.outpoint.hash
-                        and inp["vout"] == coin.outpoint.n
-                    ):
-                        self.coins.remove(coin)
+    def scan(self):
+        self.utxos.sync()
+        self.coins = self.utxos.coins.copy()
+
+        added, removed = self.mempool.update()
+        for tx in removed:
+            self.mempool_coins.pop(tx.hash, None)
+        script_pubkey = address_script(self.address)
+        for tx in added:
+            received = _received_coins(tx, script_pubkey)
+            if received:
+                self.mempool_coins[tx.hash] = received
+
+        for received in self.mempool_coins.values():
+            for coin in received:
+                self.coins.add(coin)
+
+        # drop whatever the mempool is already spending
+        for coin in list(self.coins):
+            if self.mempool.spender(coin.outpoint):
+                self.coins.spend(coin.outpoint)
 
     @property
     def address(self):
@@ -103,17 +365,15 @@ class Wallet:
 
     @property
     def max_sendable(self):
-        if not self.coins:
-            return 0
-        return max([coin.satoshis for coin in self.coins])
+        coin = self.coins.largest()
+        return coin.satoshis if coin else 0
 
     @property
     def biggest_coin(self):
-        for coin in self.coins:
-            if coin.satoshis == self.max_sendable:
-                return coin
-
-        raise ValueError("no coins!")
+        coin = self.coins.largest()
+        if coin is None:
+            raise ValueError("no coins!")
+        return coin
 
     def sign(self, tx: CTransaction, input_index: int, satoshis: int):
         pubkey160 = self.privkey.point.hash160()
@@ -147,7 +407,7 @@ class Wallet:
             self.privkey.point.sec(),
         ]
 
-        return CTransaction(tx)
+        return tx.copy()
 
 
 @dataclass(frozen=True)
@@ -155,6 +415,105 @@ class Coin:
     outpoint: COutPoint
     satoshis: int
 
+    @property
+    def key(self) -> Tuple[int, int]:
+        return (self.outpoint.hash, self.outpoint.n)
+
+
+class CoinSet:
+    """
+    Coins keyed by outpoint, with an index ordered by value.
+
+    Adding looks up the insertion point with a binary search and spending is
+    a dict removal: spent coins are only dropped from the ordered index when
+    a query runs into them, or all at once when they make up half of it.
+    The largest, smallest and best-fitting coins are found with a binary
+    search (or from either end) over the index.
+    """
+
+    def __init__(self, coins=()):
+        self._coins: Dict[Tuple[int, int], Coin] = {}
+        # (satoshis, hash, n) of the coins, possibly some already spent, at
+        # most one per outpoint
+        self._index: List[Tuple[int, int, int]] = []
+        # the value each outpoint has a live-looking index entry for
+        self._indexed: Dict[Tuple[int, int], int] = {}
+        for coin in coins:
+            self.add(coin)
+
+    def add(self, coin: Coin):
+        self._coins[coin.key] = coin
+        indexed = self._indexed.get(coin.key)
+        if indexed != coin.satoshis:
+            if indexed is not None:
+                # it would come back to life if the coin got that value again
+                del self._index[bisect.bisect_left(self._index, (indexed, *coin.key))]
+            self._indexed[coin.key] = coin.satoshis
+            bisect.insort(self._index, (coin.satoshis, *coin.key))
+
+    def spend(self, outpoint: COutPoint) -> Optional[Coin]:
+        """Removes and returns the coin at `outpoint`, if we have it."""
+        coin = self._coins.pop((outpoint.hash, outpoint.n), None)
+        if len(self._index) > 2 * len(self._coins) + 16:
+            self._compact()
+        return coin
+
+    def _compact(self):
+        self._index = [entry for entry in self._index if self._live(entry)]
+        self._indexed = {entry[1:]: entry[0] for entry in self._index}
+
+    def _live(self, entry) -> bool:
+        coin = self._coins.get(entry[1:])
+        return coin is not None and coin.satoshis == entry[0]
+
+    def _coin(self, entry) -> Coin:
+        return self._coins[entry[1:]]
+
+    def _drop(self, i: int):
+        satoshis, *key = self._index.pop(i)
+        if self._indexed.get(tuple(key)) == satoshis:
+            del self._indexed[tuple(key)]
+
+    def largest(self) -> Optional[Coin]:
+        while self._index and not self._live(self._index[-1]):
+            self._drop(-1)
+        return self._coin(self._index[-1]) if self._index else None
+
+    def smallest(self) -> Optional[Coin]:
+        return self.best_fit(0)
+
+    def best_fit(self, satoshis: int) -> Optional[Coin]:
+        """The smallest coin worth at least `satoshis`."""
+        i = bisect.bisect_left(self._index, (satoshis,))
+        while i < len(self._index):
+            if self._live(self._index[i]):
+                return self._coin(self._index[i])
+            self._drop(i)
+        return None
+
+    def copy(self) -> "CoinSet":
+        other = CoinSet()
+        other._coins = dict(self._coins)
+        other._index = list(self._index)
+        other._indexed = dict(self._indexed)
+        return other
+
+    @property
+    def total(self) -> int:
+        return sum(coin.satoshis for coin in self._coins.values())
+
+    def get(self, outpoint: COutPoint) -> Optional[Coin]:
+        return self._coins.get((outpoint.hash, outpoint.n))
+
+    def __contains__(self, outpoint: COutPoint) -> bool:
+        return (outpoint.hash, outpoint.n) in self._coins
+
+    def __len__(self):
+        return len(self._coins)
+
+    def __iter__(self):
+        return iter(list(self._coins.values()))
+
 
 def format_cscript(script: CScript) -> str:
     return " ".join(
@@ -198,3 +557,240 @@ white = make_color(esc(37), FG_END)
 bold = make_color(esc(1), esc(22))
 italic = make_color(esc(3), esc(23))
 underline = make_color(esc(4), esc(24))
+
+
+class _FakeChain(object):
+    """
+    Stands in for a node with a chain of random blocks, whose transactions
+    spend random earlier outputs and pay some of them to `script_pubkey`.
+    """
+
+    OTHER_SCRIPT = bytes(CScript([0, bytes(20)]))
+
+    def __init__(self, address: str, seed: int):
+        self.script_pubkey = address_script(address)
+        self.rng = random.Random(seed)
+        self.blocks: List[CBlock] = []
+        self.known: Dict[str, CBlock] = {}
+        self.scans = 0
+
+    def _utxos(self, our_only=False) -> Dict[Tuple[int, int], int]:
+        """The utxo set of the active chain, recomputed from scratch."""
+        utxos = {}
+        for block in self.blocks:
+            for tx in block.vtx:
+                for outpoint in _spent_outpoints(tx):
+                    utxos.pop(outpoint, None)
+                for n, out in enumerate(tx.vout):
+                    if not our_only or out.scriptPubKey == self.script_pubkey:
+                        utxos[(tx.sha256, n)] = out.nValue
+        return utxos
+
+    def _output(self) -> CTxOut:
+        ours = self.rng.random() < 0.5
+        script_pubkey = self.script_pubkey if ours else self.OTHER_SCRIPT
+        return CTxOut(self.rng.randrange(1, 10 * COIN), script_pubkey)
+
+    def mine(self):
+        rng = self.rng
+        block = CBlock()
+        block.hashPrevBlock = self.blocks[-1].sha256 if self.blocks else 0
+        block.nTime = rng.randrange(2**32)
+
+        coinbase = CTransaction()
+        coinbase.vin = [CTxIn(COutPoint(0, 0xFFFFFFFF), rng.randbytes(8))]
+        coinbase.vout = [self._output()]
+        coinbase.rehash()
+        block.vtx = [coinbase]
+
+        # outputs created earlier in the block can be spent too
+        available = list(self._utxos())
+        available += [(coinbase.sha256, 0)]
+        for _ in range(rng.randrange(6)):
+            tx = CTransaction()
+            for _ in range(min(rng.randrange(1, 3), len(available))):
+                outpoint = available.pop(rng.randrange(len(available)))
+                tx.vin.append(CTxIn(COutPoint(*outpoint)))
+            tx.vout = [self._output() for _ in range(rng.randrange(1, 4))]
+            tx.rehash()
+            available += [(tx.sha256, n) for n in range(len(tx.vout))]
+            block.vtx.append(tx)
+
+        block.hashMerkleRoot = block.calc_merkle_root()
+        block.rehash()
+        self.blocks.append(block)
+        self.known[block.hash] = block
+
+    def reorg(self, depth: int):
+        """Replaces the last `depth` blocks with `depth + 1` other ones."""
+        del self.blocks[len(self.blocks) - depth :]
+        for _ in range(depth + 1):
+            self.mine()
+
+    def getblockcount(self):
+        return len(self.blocks) - 1
+
+    def getblockhash(self, height):
+        if not 0 <= height < len(self.blocks):
+            raise JSONRPCError({"code": -8, "message": "Block height out of range"})
+        return self.blocks[height].hash
+
+    def getblock(self, block_hash, verbosity):
+        return self.known[block_hash].serialize().hex()
+
+    def scantxoutset(self, action, descriptors):
+        self.scans += 1
+        unspents = [
+            {"txid": "%064x" % txid, "vout": n, "amount": Decimal(value) / COIN}
+            for (txid, n), value in self._utxos(our_only=True).items()
+        ]
+        tip = self.blocks[-1].hash
+        return {"unspents": unspents, "bestblock": tip, "height": len(self.blocks) - 1}
+
+    def batch(self):
+        return RPCBatch(self)
+
+    def _call_batch(self, calls, timeout=None):
+        results = []
+        for name, args in calls:
+            try:
+                results.append(getattr(self, name)(*args))
+            except JSONRPCError as err:
+                results.append(err)
+        return results
+
+
+class TestCoinSet(unittest.TestCase):
+    def check(self, coins: "CoinSet", expected: Dict[Tuple[int, int], int]):
+        self.assertEqual({coin.key: coin.satoshis for coin in coins}, expected)
+        self.assertEqual(len(coins), len(expected))
+        self.assertEqual(coins.total, sum(expected.values()))
+        # one index entry for each coin at most, in order
+        self.assertEqual(coins._index, sorted(coins._index))
+        outpoints = [entry[1:] for entry in coins._index]
+        self.assertEqual(len(outpoints), len(set(outpoints)))
+        live = [entry for entry in coins._index if coins._live(entry)]
+        self.assertEqual(sorted(entry[1:] for entry in live), sorted(expected))
+
+        ordered = sorted((value, *key) for key, value in expected.items())
+        largest = coins.largest()
+        self.assertEqual(
+            largest and (largest.satoshis, *largest.key), max(ordered, default=None)
+        )
+        for satoshis in [0, 1, 250, 500, 999, 1000]:
+            fits = [entry for entry in ordered if entry[0] >= satoshis]
+            coin = coins.best_fit(satoshis)
+            self.assertEqual(
+                coin and (coin.satoshis, *coin.key), min(fits, default=None)
+            )
+
+    def test_against_dict(self):
+        rng = random.Random(13)
+        coins, expected = CoinSet(), {}
+        copies = []
+        for step in range(3000):
+            key = (rng.randrange(40), rng.randrange(3))
+            if rng.random() < (0.3 if step % 1000 < 500 else 0.7):
+                # re-adding a spent outpoint, possibly with another value
+                satoshis = rng.randrange(1000)
+                coins.add(Coin(COutPoint(*key), satoshis))
+                expected[key] = satoshis
+            else:
+                coin = coins.spend(COutPoint(*key))
+                value = expected.pop(key, None)
+                self.assertEqual(coin and coin.satoshis, value)
+            if step % 100 == 0:
+                self.check(coins, expected)
+                copies.append((coins.copy(), dict(expected)))
+        self.check(coins, expected)
+
+        # copies kept their own coins through all of the above, and go on
+        # independently of the original
+        for copy, copy_expected in copies:
+            self.check(copy, copy_expected)
+            for key in list(copy_expected)[::2]:
+                copy.spend(COutPoint(*key))
+                del copy_expected[key]
+            copy.add(Coin(COutPoint(99, 0), 5))
+            copy_expected[(99, 0)] = 5
+            self.check(copy, copy_expected)
+        self.check(coins, expected)
+
+
+class TestUtxoTracker(unittest.TestCase):
+    ADDRESS = encode_segwit_address("tb", 0, bytes(range(20)))
+
+    def setUp(self):
+        global rpc, UNDO_DEPTH
+        self.node = _FakeChain(self.ADDRESS, 14)
+        self.saved = rpc, UNDO_DEPTH
+        rpc, UNDO_DEPTH = self.node, 4
+
+    def tearDown(self):
+        global rpc, UNDO_DEPTH
+        rpc, UNDO_DEPTH = self.saved
+
+    def check(self, tracker: UtxoTracker):
+        tracker.sync()
+        coins = {coin.key: coin.satoshis for coin in tracker.coins}
+        self.assertEqual(coins, self.node._utxos(our_only=True))
+        self.assertEqual(tracker.tip, self.node.blocks[-1].hash)
+        self.assertEqual(tracker.height, len(self.node.blocks) - 1)
+
+    def test_against_rescan(self):
+        node = self.node
+        for _ in range(5):
+            node.mine()
+        tracker = UtxoTracker(self.ADDRESS)
+        self.check(tracker)
+        self.assertEqual(node.scans, 1)
+
+        for _ in range(60):
+            if node.rng.random() < 0.3:
+                node.reorg(node.rng.randrange(1, UNDO_DEPTH + 1))
+            else:
+                for _ in range(node.rng.randrange(1, 2 * BLOCK_BATCH)):
+                    node.mine()
+            self.check(tracker)
+        self.assertEqual(node.scans, 1)
+
+        # a reorg deeper than the undo data falls back to a rescan
+        node.reorg(UNDO_DEPTH + 1)
+        self.check(tracker)
+        self.assertEqual(node.scans, 2)
+        # and undo data is kept again from there on
+        for _ in range(3):
+            node.mine()
+        self.check(tracker)
+        node.reorg(2)
+        self.check(tracker)
+        self.assertEqual(node.scans, 2)
+
+    def test_spent_in_same_block(self):
+        node = self.node
+        node.mine()
+        tracker = UtxoTracker(self.ADDRESS)
+        self.check(tracker)
+
+        # a block creating one of our coins and spending it right away
+        node.mine()
+        block = node.blocks.pop()
+        funding = CTransaction()
+        funding.vin = [CTxIn(COutPoint(block.vtx[0].sha256, 0))]
+        funding.vout = [CTxOut(5, node.script_pubkey)]
+        funding.rehash()
+        spending = CTransaction()
+        spending.vin = [CTxIn(COutPoint(funding.sha256, 0))]
+        spending.vout = [CTxOut(4, node.OTHER_SCRIPT)]
+        spending.rehash()
+        block.vtx = [block.vtx[0], funding, spending]
+        block.hashMerkleRoot = block.calc_merkle_root()
+        block.rehash()
+        node.blocks.append(block)
+        node.known[block.hash] = block
+        self.check(tracker)
+        self.assertNotIn(COutPoint(funding.sha256, 0), tracker.coins)
+
+        node.reorg(1)
+        self.check(tracker)
+        self.assertEqual(node.scans, 1)